@@ -8,11 +8,17 @@ from config import BaseConfig
 
 app = Flask(__name__)
 app.config.from_object(BaseConfig)
+if app.config.get('DB_BACKEND') == 'sqlite':
+	import sqlite
+	sqlite.prepare(app.config['SQLITE_PATH'])
 db = SQLAlchemy(app)
 
 from tasks import BackgroundTasks
 from box import Box
 from models import *
+from measures import parse_timestamp
+import query
+from store import series, seed_recent_series, user_usage_series, distinct_series, range_sketch, heavy_hitters
 
 tasks = BackgroundTasks(app.logger)
 
@@ -60,18 +66,76 @@ def velocity_engagement():
 def velocity_uniqueusers():
 	return render_template('unique-users.html')
 
+def since():
+	# optional tick (ms from epoch) to start from; the charts poll with it to fetch only their latest points
+	tick = request.args.get('since')
+	return None if tick is None else datetime.datetime.fromtimestamp(float(tick) / 1000, datetime.timezone.utc)
+
+def date_arg(name):
+	# a required YYYY-MM-DD (UTC midnight) or full ISO 8601 timestamp argument
+	value = request.args[name]
+	return parse_timestamp(value if 'T' in value else value + 'T00:00:00Z')
+
 @app.route('/event/stat', methods=['GET'])
 def velocity():
-	result = []
-	epoch = datetime.datetime.utcfromtimestamp(0)
+	# resolution is minute (the default), hour, day or week
+	resolution = request.args.get('resolution', 'minute')
+	try:
+		result = series(request.args.get('event_type').split(','), resolution, since())
+	except ValueError as e:
+		return Response(json.dumps({'error': str(e)}), status=400, mimetype='application/json')
+	return Response(json.dumps(result),  mimetype='application/json')
+
+@app.route('/event/query', methods=['GET'])
+def event_query():
+	# ad-hoc questions over the local event archive, e.g.
+	#   ?start=2015-07-01&end=2015-10-01&event_type=DOWNLOAD&group_by=login
+	#   ?start=2015-07-01&end=2015-10-01&distinct=ip_address&bucket=day
+	if tasks.archive is None:
+		return Response(json.dumps({'error': 'EVENT_ARCHIVE_DIR is not set'}), status=404, mimetype='application/json')
+	try:
+		starting = date_arg('start')
+		ending = date_arg('end')
+		group_by = [name for name in request.args.get('group_by', '').split(',') if name]
+		bucket = request.args.get('bucket')
+		filters = dict((name, request.args[name].split(',')) for name in query.columns if name in request.args)
+		frame = query.EventQuery(tasks.archive).load(starting, ending).where(**filters)
+		if 'distinct' in request.args:
+			result = frame.distinct(request.args['distinct'], by=group_by, bucket=bucket)
+		else:
+			result = frame.count(by=group_by, bucket=bucket)
+	except (KeyError, ValueError) as e:
+		return Response(json.dumps({'error': 'Bad query: {0}'.format(e)}), status=400, mimetype='application/json')
+	return Response(json.dumps(result),  mimetype='application/json')
 
-	event_types = request.args.get('event_type').split(',')
-	for event_type in event_types:
-		series = []
-		stats = Stat.query.filter(Stat.measure == event_type).order_by(Stat.starting.asc()).all()
-		for stat in stats:
-			series.append([(stat.starting - epoch).total_seconds() * 1000, stat.value])
-		result.append(series)
+@app.route('/event/unique', methods=['GET'])
+def event_unique():
+	# approximate distinct counts over any range from the stored sketches, e.g. daily active users:
+	#   ?start=2015-07-01&end=2015-10-01&bucket=day
+	# without bucket, one point for the whole range
+	try:
+		measure = request.args.get('measure', 'UNIQUE_USERS')
+		starting = date_arg('start')
+		ending = date_arg('end')
+		if 'bucket' in request.args:
+			result = distinct_series(measure, starting, ending, request.args['bucket'])
+		else:
+			result = [[(starting.replace(tzinfo=None) - datetime.datetime.utcfromtimestamp(0)).total_seconds() * 1000, range_sketch(measure, starting, ending).count()]]
+	except (KeyError, ValueError) as e:
+		return Response(json.dumps({'error': 'Bad query: {0}'.format(e)}), status=400, mimetype='application/json')
+	return Response(json.dumps(result),  mimetype='application/json')
+
+@app.route('/event/top', methods=['GET'])
+def event_top():
+	# the most active users or items over any range from the stored sketches, e.g.
+	#   ?measure=TOP_DOWNLOADERS&start=2015-07-01&end=2015-08-01&n=10
+	try:
+		starting = date_arg('start')
+		ending = date_arg('end')
+		top = heavy_hitters(request.args['measure'], starting, ending, int(request.args.get('n', 10)))
+	except (KeyError, ValueError) as e:
+		return Response(json.dumps({'error': 'Bad query: {0}'.format(e)}), status=400, mimetype='application/json')
+	result = [{'value': value, 'count': count, 'error': error} for value, count, error in top]
 	return Response(json.dumps(result),  mimetype='application/json')
 
 @app.route('/usage/user', methods=['GET'])
@@ -80,16 +144,31 @@ def usage_user():
 
 @app.route('/usage/stat', methods=['GET'])
 def usage():
-	result = []
-	epoch = datetime.datetime.utcfromtimestamp(0)
+	# resolution is minute (the default), hour, day or week
+	resolution = request.args.get('resolution', 'minute')
+	try:
+		result = series(request.args.get('type').split(','), resolution, since())
+	except ValueError as e:
+		return Response(json.dumps({'error': str(e)}), status=400, mimetype='application/json')
+	return Response(json.dumps(result),  mimetype='application/json')
 
-	event_types = request.args.get('type').split(',')
-	for event_type in event_types:
-		series = []
-		stats = Stat.query.filter(Stat.measure == event_type).order_by(Stat.starting.asc()).all()
-		for stat in stats:
-			series.append([(stat.starting - epoch).total_seconds() * 1000, stat.value])
-		result.append(series)
+@app.route('/usage/user/stat', methods=['GET'])
+def usage_user_stat():
+	# one user's storage series, rebuilt hourly from the recorded changes
+	epoch = datetime.datetime.utcfromtimestamp(0)
+	ending = datetime.datetime.utcnow().replace(minute=0, second=0, microsecond=0) + datetime.timedelta(hours=1)
+	starting = ending - datetime.timedelta(days=int(request.args.get('days', 30)))
+	points = []
+	for recorded, status, space_used in user_usage_series(request.args.get('user_id'), starting, ending):
+		points.append([(recorded - epoch).total_seconds() * 1000, space_used/(1024*1024*1024)])
+	return Response(json.dumps(points),  mimetype='application/json')
+
+@app.route('/usage/top', methods=['GET'])
+def usage_top():
+	# the heaviest users as of the latest usage run
+	latest = db.session.query(db.func.max(TopUser.starting)).scalar()
+	users = TopUser.query.filter(TopUser.starting == latest).order_by(TopUser.rank.asc()).limit(int(request.args.get('n', 20))).all()
+	result = [{'user_id': user.user_id, 'login': user.login, 'space_used_gb': user.space_used/(1024*1024*1024)} for user in users]
 	return Response(json.dumps(result),  mimetype='application/json')
 
 @app.route('/usage/trigger', methods=['GET'])
@@ -105,6 +184,7 @@ def event_trigger():
 @app.before_first_request
 def init():
 	app.logger.debug("Init pid {}".format(os.getpid()))
+	seed_recent_series()
 	tasks.schedule()
 
 if __name__ == '__main__':
@@ -0,0 +1,87 @@
+# archive.py
+
+import os
+import json
+import gzip
+import datetime
+import threading
+from measures import parse_timestamp
+
+
+def compact(event):
+	"""Keep only the event fields the reports use, in the same nested shape Box returns them."""
+	created_by = event.get('created_by') or {}
+	source = event.get('source') or {}
+	record = {
+		'event_id': event['event_id'],
+		'event_type': event.get('event_type'),
+		'created_at': parse_timestamp(event['created_at']).strftime('%Y-%m-%dT%H:%M:%SZ'),
+		'created_by': {'login': created_by.get('login')},
+		'source': dict((key, source[key]) for key in ('id', 'type', 'item_id', 'item_type') if source.get(key) is not None),
+	}
+	if event.get('ip_address') is not None:
+		record['ip_address'] = event['ip_address']
+	return record
+
+
+class EventArchive(object):
+	"""
+	Append-only local archive of admin_logs events, partitioned by the hour of created_at.
+
+	Each partition is a gzip file of JSON lines at <path>/YYYY/MM/DD/HH.jsonl.gz, and every append
+	adds a new gzip member to it, so nothing already written is rewritten. The same event may be
+	appended more than once (catch-up sweeps, retries); reads return it once.
+	"""
+
+	def __init__(self, path):
+		self.path = path
+		self.lock = threading.Lock()
+
+	def partition(self, hour):
+		return os.path.join(self.path, hour.strftime('%Y'), hour.strftime('%m'), hour.strftime('%d'), hour.strftime('%H') + '.jsonl.gz')
+
+	def append(self, events):
+		partitions = {}
+		for event in events:
+			record = compact(event)
+			hour = parse_timestamp(record['created_at']).replace(minute=0, second=0)
+			partitions.setdefault(hour, []).append(json.dumps(record, separators=(',', ':')))
+		# backfill workers append concurrently, and two writers must not interleave inside a partition
+		with self.lock:
+			for hour, lines in partitions.items():
+				filename = self.partition(hour)
+				if not os.path.isdir(os.path.dirname(filename)):
+					os.makedirs(os.path.dirname(filename))
+				with gzip.open(filename, 'ab') as archive:
+					archive.write(('\n'.join(lines) + '\n').encode('utf-8'))
+		return sum(len(lines) for lines in partitions.values())
+
+	def hours(self, starting, ending):
+		"""The partitions overlapping [starting, ending) that exist on disk, oldest first."""
+		hour = starting.replace(minute=0, second=0, microsecond=0)
+		while hour < ending:
+			filename = self.partition(hour)
+			if os.path.exists(filename):
+				yield hour, filename
+			hour += datetime.timedelta(hours=1)
+
+	def read(self, starting, ending):
+		"""Yield archived events created in [starting, ending), oldest partition first."""
+		for hour, filename in self.hours(starting, ending):
+			# duplicates always land in the same partition since it is chosen by created_at
+			seen = set()
+			for record in self.records(filename):
+				if record['event_id'] in seen:
+					continue
+				seen.add(record['event_id'])
+				if starting <= parse_timestamp(record['created_at']) < ending:
+					yield record
+
+	def records(self, filename):
+		with gzip.open(filename, 'rb') as archive:
+			try:
+				for line in archive:
+					yield json.loads(line.decode('utf-8'))
+			except (EOFError, ValueError):
+				# an append cut short by a crash leaves a truncated last member; everything before it is intact
+				pass
@@ -0,0 +1,42 @@
+#backfill.py
+
+import sys
+import logging
+import argparse
+import datetime
+from app import app, tasks
+from store import rebuild_rollups, rolled_up_weeks
+
+
+def utc_date(value):
+	return datetime.datetime.strptime(value, '%Y-%m-%d').replace(tzinfo=datetime.timezone.utc)
+
+parser = argparse.ArgumentParser(description='Backfill per-minute event stats from the Box admin_logs history.')
+parser.add_argument('starting', type=utc_date, help='first day to backfill (YYYY-MM-DD, UTC)')
+parser.add_argument('ending', type=utc_date, help='day to stop before (YYYY-MM-DD, UTC)')
+parser.add_argument('--slice-minutes', type=int, default=360, help='length of the time slice fetched by one worker')
+parser.add_argument('--workers', type=int, default=4, help='number of slices fetched concurrently')
+parser.add_argument('--from-archive', action='store_true', help='recompute from the local event archive instead of calling Box')
+parser.add_argument('--rollups', action='store_true', help='only rebuild the hour, day and week rollups from the stored minute rows')
+args = parser.parse_args()
+
+logging.basicConfig(level=logging.INFO)
+app.logger.setLevel(logging.INFO)
+
+# minutes past the retention may already be pruned into the rollups of their weeks; writing them again
+# would count them twice there, and rebuilding those weeks would drop them. Weeks without rollups are
+# safe: the next compaction rolls them up before pruning them.
+minutes_before = tasks.retention_cutoffs()[0]
+if minutes_before is not None and args.starting < minutes_before:
+	weeks = rolled_up_weeks(args.starting, min(args.ending, minutes_before))
+	if weeks:
+		sys.exit('The weeks of {0} to {1} already have rollups and minute stats past STAT_MINUTE_RETENTION_DAYS ({2}); start the range on or after {3}.'.format(
+			weeks[0].date(), weeks[-1].date(), minutes_before.date(), (weeks[-1] + datetime.timedelta(days=7)).date()))
+
+if args.rollups:
+	rebuild_rollups(args.starting, args.ending)
+elif args.from_archive:
+	if not tasks.recompute_velocity(args.starting, args.ending):
+		sys.exit('Recompute failed; see the log above.')
+elif not tasks.backfill_velocity(args.starting, args.ending, args.slice_minutes, args.workers):
+	sys.exit('Some slices failed; run the same command again to retry them.')
@@ -2,9 +2,10 @@
 
 import os
 import logging
+import datetime
 from app import db 
 from boxsdk import OAuth2, Client 
-from models import Setting
+from models import Setting, Checkpoint
 
 class Box(object):
 	
@@ -66,4 +67,35 @@ class Box(object):
 	
 	def authorize(self, code):
 		self.logger.info('Authorizing OAuth2 code...')
-		access_token, refresh_token = self.oauth2().authenticate(code)
\ No newline at end of file
+		access_token, refresh_token = self.oauth2().authenticate(code)
+		# a different admin may belong to a different enterprise
+		self.set_value('enterprise_id', '')
+
+	def enterprise_id(self, client):
+		enterprise_id = self.get_setting('enterprise_id')
+		if enterprise_id:
+			return enterprise_id
+		try:
+			enterprise = client.user(user_id='me').get(fields=['enterprise'])['enterprise']
+		except Exception as e:
+			self.logger.warn('Could not look up enterprise of the authorized user: {0}'.format(e))
+			return None
+		if enterprise is None:
+			return None
+		self.set_value('enterprise_id', enterprise['id'])
+		return enterprise['id']
+
+	def get_stream_position(self, enterprise_id, stream_type='admin_logs'):
+		checkpoint = Checkpoint.query.filter(Checkpoint.enterprise_id == enterprise_id, Checkpoint.stream_type == stream_type).first()
+		if checkpoint is None:
+			return 0
+		return checkpoint.stream_position
+
+	def set_stream_position(self, enterprise_id, stream_position, stream_type='admin_logs'):
+		checkpoint = Checkpoint.query.filter(Checkpoint.enterprise_id == enterprise_id, Checkpoint.stream_type == stream_type).first()
+		if checkpoint is None:
+			checkpoint = Checkpoint(enterprise_id, stream_type, str(stream_position))
+			db.session.add(checkpoint)
+		checkpoint.stream_position = str(stream_position)
+		checkpoint.updated = datetime.datetime.utcnow()
+		db.session.commit()
\ No newline at end of file
@@ -176,7 +176,7 @@ class BaseObject(BaseEndpoint):
         """Base class override. Equality is determined by object id."""
         return self._object_id == other.object_id
 
-    def _paging_wrapper(self, url, starting_index, limit, factory=None):
+    def _paging_wrapper(self, url, starting_index, limit, factory=None, use_marker=False):
         """
         Helper function that turns any paging API into a generator that transparently implements the paging for
         the caller.
@@ -206,6 +206,12 @@ class BaseObject(BaseEndpoint):
             signature of BaseObject. If no factory is given then the Translator factory is used.
         :type factory:
             `callable` or None
+        :param use_marker:
+            Page with the endpoint's markers (usemarker/next_marker) instead of offsets, for endpoints that support
+            it. Every page then costs the same however deep the scan is, and items are neither skipped nor repeated
+            when the collection changes during the scan. starting_index must be 0 in this mode.
+        :type use_marker:
+            `bool`
         :returns:
             A generator of 3-tuples. Each tuple contains:
             1) An instance returned by the given factory callable.
@@ -215,9 +221,17 @@ class BaseObject(BaseEndpoint):
             `generator` of `tuple` of (varies, `int`, `int`)
         """
         current_index = starting_index
+        marker = None
+        if use_marker and starting_index:
+            raise ValueError('Marker paging can only start at the beginning of the collection.')
 
         while True:
-            params = {'limit': limit, 'offset': current_index}
+            if use_marker:
+                params = {'limit': limit, 'usemarker': 'true'}
+                if marker:
+                    params['marker'] = marker
+            else:
+                params = {'limit': limit, 'offset': current_index}
             box_response = self._session.get(url, params=params)
             response = box_response.json()
 
@@ -229,6 +243,11 @@ class BaseObject(BaseEndpoint):
                 instance = instance_factory(self._session, item['id'], item)
                 yield instance, current_page_size, index_in_current_page
 
+            if use_marker:
+                marker = response.get('next_marker')
+                if not marker:
+                    break
+                continue
             current_index += limit
             if current_index >= response['total_count']:
                 break
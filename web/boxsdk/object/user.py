@@ -10,7 +10,7 @@ class User(BaseObject):
 
     _item_type = 'user'
 
-    def get_enterprise_users(self, limit=100, offset=0, filter_term=None):
+    def get_enterprise_users(self, limit=100, offset=0, filter_term=None, fields=None, use_marker=False, marker=None):
         """
         Get enterprise users. Requires an auth token from an enterprise admin account.
 
@@ -26,6 +26,19 @@ class User(BaseObject):
             A string used to filter the results to only users starting with the filter_term in either the name or the login.
         :type event_type:
             'unicode'        
+        :param fields:
+            List of user fields to return instead of the default representation.
+        :type fields:
+            `Iterable` of `unicode` or None
+        :param use_marker:
+            Page with markers instead of offsets. offset is then ignored, and the response has a 'next_marker'
+            to pass as marker for the next page (empty or missing on the last page) instead of 'total_count'.
+        :type use_marker:
+            `bool`
+        :param marker:
+            The next_marker returned with the previous page, or None for the first page.
+        :type marker:
+            `unicode` or None
         :returns:
             JSON response from the Box /users endpoint. Returns the list of all users for the Enterprise with their
             user_id, public_name, and login if the user is an enterprise admin.
@@ -35,11 +48,18 @@ class User(BaseObject):
         url = 'https://api.box.com/2.0/users' #self.get_url()
         params = {
             'limit': limit,
-            'offset': offset
         }
         
+        if use_marker:
+            params['usemarker'] = 'true'
+            if marker:
+                params['marker'] = marker
+        else:
+            params['offset'] = offset
         if filter_term is not None:
             params['filter_term'] = filter_term
+        if fields:
+            params['fields'] = ','.join(fields)
         
         box_response = self._session.get(url, params=params)
         return box_response.json()
\ No newline at end of file
@@ -6,14 +6,37 @@ import os
 
 class BaseConfig(object):
     DEBUG = os.environ['DEBUG']
-    DB_NAME = os.environ['DB_NAME']
-    DB_USER = os.environ['DB_USER']
-    DB_PASS = os.environ['DB_PASS']
-    DB_SERVICE = os.environ['DB_SERVICE']
-    DB_PORT = os.environ['DB_PORT']
-    SQLALCHEMY_DATABASE_URI = 'postgresql://{0}:{1}@{2}:{3}/{4}'.format(
-        DB_USER, DB_PASS, DB_SERVICE, DB_PORT, DB_NAME
-    )
+    # 'postgresql' (the postgres container) or 'sqlite' (an embedded database file, for single-node deployments)
+    DB_BACKEND = os.environ.get('DB_BACKEND', 'postgresql')
+    if DB_BACKEND == 'sqlite':
+        SQLITE_PATH = os.environ.get('SQLITE_PATH', '/var/lib/hero-report/db/hero-report.db')
+        SQLALCHEMY_DATABASE_URI = 'sqlite:///' + SQLITE_PATH
+    else:
+        DB_NAME = os.environ['DB_NAME']
+        DB_USER = os.environ['DB_USER']
+        DB_PASS = os.environ['DB_PASS']
+        DB_SERVICE = os.environ['DB_SERVICE']
+        DB_PORT = os.environ['DB_PORT']
+        SQLALCHEMY_DATABASE_URI = 'postgresql://{0}:{1}@{2}:{3}/{4}'.format(
+            DB_USER, DB_PASS, DB_SERVICE, DB_PORT, DB_NAME
+        )
+    # local archive of raw admin_logs events; unset to disable
+    EVENT_ARCHIVE_DIR = os.environ.get('EVENT_ARCHIVE_DIR')
+    # follow the admin_logs stream continuously instead of fetching once a minute
+    EVENT_TAILER = os.environ.get('EVENT_TAILER', '').lower() in ('1', 'true', 'yes')
+    # 'marker' scans the user directory consistently page after page; 'offset' fetches pages concurrently
+    USER_PAGING = os.environ.get('USER_PAGING', 'marker')
+    # days of per-minute stats and of hourly rollups to keep; 0 keeps them forever
+    STAT_MINUTE_RETENTION_DAYS = int(os.environ.get('STAT_MINUTE_RETENTION_DAYS', 30))
+    STAT_HOUR_RETENTION_DAYS = int(os.environ.get('STAT_HOUR_RETENTION_DAYS', 730))
+    # 'rows' stores one stats row per measure and minute; 'wide' stores one stat_windows row per minute
+    STAT_LAYOUT = os.environ.get('STAT_LAYOUT', 'rows')
+    # partition the stats table by month (PostgreSQL 11 or later, 'rows' layout); set before running create_db.py
+    STAT_PARTITIONS = os.environ.get('STAT_PARTITIONS', '').lower() in ('1', 'true', 'yes')
+    # days of recent per-minute stats each worker keeps in memory for the charts' polling; 0 disables
+    RECENT_SERIES_DAYS = int(os.environ.get('RECENT_SERIES_DAYS', 7))
+    # how often a worker checks whether other processes wrote stats; their writes reach its charts that much later
+    RECENT_SERIES_CHECK_SECONDS = int(os.environ.get('RECENT_SERIES_CHECK_SECONDS', 30))
 
 
 # class BaseConfig(object):
@@ -2,5 +2,9 @@
 
 
 from app import db
+import partitions
 
+# the partitioned stats table has to exist before create_all, which would create a plain one
+if partitions.enabled():
+	partitions.create_partitioned_table()
 db.create_all()
\ No newline at end of file
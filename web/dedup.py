@@ -0,0 +1,41 @@
+# dedup.py
+
+import datetime
+from boxsdk.util.lru_cache import LRUCache
+
+
+class EventDedup(LRUCache):
+	"""
+	Remembers the event_ids seen recently so an event delivered twice is only counted once.
+
+	An id is forgotten once its event is more than `horizon` older than the newest event seen, and
+	never more than `capacity` ids are kept (least recently seen first out), so memory stays bounded
+	however many events flow through.
+	"""
+
+	def __init__(self, horizon=datetime.timedelta(minutes=10), capacity=200000):
+		super(EventDedup, self).__init__(capacity)
+		self.horizon = horizon
+		self.newest = None
+
+	def seen(self, event_id, created_at):
+		"""Return True if event_id was already seen, otherwise remember it and return False."""
+		try:
+			self.get(event_id)
+			return True
+		except KeyError:
+			pass
+		if self.newest is None or created_at > self.newest:
+			self.newest = created_at
+			self.expire()
+		self.set(event_id, created_at)
+		return False
+
+	def expire(self):
+		# ids are mostly inserted in created_at order, so expired ones collect at the front
+		cutoff = self.newest - self.horizon
+		while self.cache:
+			event_id = next(iter(self.cache))
+			if self.cache[event_id] >= cutoff:
+				break
+			self.cache.popitem(last=False)
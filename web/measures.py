@@ -0,0 +1,484 @@
+# measures.py
+
+# Declarative measures over Box API entries (admin_logs events, enterprise users).
+# Every measure in a MeasureSet is computed in the same single pass over the entries,
+# so adding a measure costs neither another API sweep nor another scan.
+
+import re
+import heapq
+import bisect
+import datetime
+from sketches import HyperLogLog, SpaceSaving
+
+
+def get_field(entry, field):
+	"""Look up a dotted field such as 'created_by.login', returning None when any part is missing."""
+	value = entry
+	for part in field.split('.'):
+		if not isinstance(value, dict):
+			return None
+		value = value.get(part)
+	return value
+
+
+class Measure(object):
+	"""
+	A named value computed from the entries matching a filter.
+
+	:param name:
+		The measure name written to Stat.measure.
+	:param event_type:
+		An event type or list of event types to select, or None for any.
+	:param where:
+		A dict of dotted field -> required value; all must match.
+	:param rollup:
+		How the per-minute values roll up into hours, days and weeks: 'sum', 'last' (gauges), 'sketch'
+		(estimated from the merged sketches), or None when they cannot be combined. Defaults to the
+		measure kind's `rollup`.
+	"""
+
+	rollup = 'sum'
+	# the sketch class kept per minute alongside the Stat rows, if any
+	sketch = None
+
+	def __init__(self, name, event_type=None, where=None, rollup=False):
+		self.name = name
+		if rollup is not False:
+			self.rollup = rollup
+		if event_type is None or isinstance(event_type, (list, tuple, set, frozenset)):
+			self.event_types = None if event_type is None else frozenset(event_type)
+		else:
+			self.event_types = frozenset([event_type])
+		self.where = where or {}
+
+	@property
+	def fields(self):
+		"""The entry fields this measure reads."""
+		fields = set(self.where)
+		if self.event_types is not None:
+			fields.add('event_type')
+		return fields
+
+	def matches(self, entry):
+		# event_type is already checked by the MeasureSet routing
+		for field, value in self.where.items():
+			if get_field(entry, field) != value:
+				return False
+		return True
+
+	def accumulator(self):
+		raise NotImplementedError
+
+	def stats(self, value):
+		"""The (Stat measure, value) rows for a result; measures that are not Stat rows return none."""
+		return [(self.name, value)]
+
+	def stat_names(self):
+		return [self.name]
+
+	def __repr__(self):
+		return '{0}({1!r})'.format(self.__class__.__name__, self.name)
+
+
+class Count(Measure):
+	"""Number of matching entries."""
+
+	def accumulator(self):
+		return CountAccumulator()
+
+
+class DistinctCount(Measure):
+	"""
+	Number of distinct non-null values of `field` among matching entries. With `sketch` the values are
+	also kept as a HyperLogLog per minute, from which distinct counts over any range are estimated.
+	"""
+
+	# distinct counts of different minutes cannot be added up
+	rollup = None
+
+	def __init__(self, name, field, event_type=None, where=None, rollup=False, sketch=False):
+		if sketch and rollup is False:
+			rollup = 'sketch'
+		super(DistinctCount, self).__init__(name, event_type, where, rollup)
+		self.field = field
+		if sketch:
+			self.sketch = HyperLogLog
+
+	@property
+	def fields(self):
+		return super(DistinctCount, self).fields | set([self.field])
+
+	def accumulator(self):
+		return DistinctAccumulator(self.field)
+
+
+class Sum(Measure):
+	"""Sum of `field` over matching entries, multiplied by `scale`."""
+
+	def __init__(self, name, field, event_type=None, where=None, scale=1, rollup=False):
+		super(Sum, self).__init__(name, event_type, where, rollup)
+		self.field = field
+		self.scale = scale
+
+	@property
+	def fields(self):
+		return super(Sum, self).fields | set([self.field])
+
+	def accumulator(self):
+		return SumAccumulator(self.field, self.scale)
+
+
+class TopN(Measure):
+	"""
+	The `n` matching entries with the largest `field`, kept in a bounded heap rather than sorted,
+	as a list of dicts holding `field` and `keep` (largest first). Not written as Stat rows.
+	"""
+
+	rollup = None
+
+	def __init__(self, name, field, keep=(), n=20, event_type=None, where=None):
+		super(TopN, self).__init__(name, event_type, where)
+		self.field = field
+		self.keep = tuple(keep)
+		self.n = n
+
+	@property
+	def fields(self):
+		return super(TopN, self).fields | set([self.field]) | set(self.keep)
+
+	def accumulator(self):
+		return TopNAccumulator(self.field, self.keep, self.n)
+
+	def stats(self, value):
+		return []
+
+	def stat_names(self):
+		return []
+
+
+class HeavyHitters(Measure):
+	"""
+	The most frequent values of `field` among matching entries (such as the busiest users), tracked in
+	a SpaceSaving sketch of `capacity` counters however many distinct values there are. Kept as a
+	sketch per minute and merged over any range; not written as Stat rows.
+	"""
+
+	rollup = None
+	sketch = SpaceSaving
+
+	def __init__(self, name, field, capacity=100, event_type=None, where=None):
+		super(HeavyHitters, self).__init__(name, event_type, where)
+		self.field = field
+		self.capacity = capacity
+
+	@property
+	def fields(self):
+		return super(HeavyHitters, self).fields | set([self.field])
+
+	def accumulator(self):
+		return HeavyHittersAccumulator(self.field, self.capacity)
+
+	def stats(self, value):
+		return []
+
+	def stat_names(self):
+		return []
+
+
+class Histogram(Measure):
+	"""
+	Number of matching entries whose `field` falls in each of fixed buckets, given as a list of
+	(label, lower bound) in increasing order. Written as one Stat row per bucket, named NAME_LABEL.
+	"""
+
+	def __init__(self, name, field, buckets, event_type=None, where=None, rollup=False):
+		super(Histogram, self).__init__(name, event_type, where, rollup)
+		self.field = field
+		self.labels = [label for label, bound in buckets]
+		self.bounds = [bound for label, bound in buckets]
+
+	@property
+	def fields(self):
+		return super(Histogram, self).fields | set([self.field])
+
+	def accumulator(self):
+		return HistogramAccumulator(self.field, self.bounds)
+
+	def stats(self, value):
+		return [('{0}_{1}'.format(self.name, label), count) for label, count in zip(self.labels, value)]
+
+	def stat_names(self):
+		return ['{0}_{1}'.format(self.name, label) for label in self.labels]
+
+
+class CountAccumulator(object):
+
+	def __init__(self):
+		self.count = 0
+
+	def add(self, entry):
+		self.count += 1
+
+	def result(self):
+		return self.count
+
+
+class DistinctAccumulator(object):
+
+	def __init__(self, field):
+		self.field = field
+		self.values = set()
+
+	def add(self, entry):
+		value = get_field(entry, self.field)
+		if value is not None:
+			self.values.add(value)
+
+	def result(self):
+		return len(self.values)
+
+	def sketch(self):
+		return HyperLogLog().update(self.values)
+
+
+class SumAccumulator(object):
+
+	def __init__(self, field, scale):
+		self.field = field
+		self.scale = scale
+		self.total = 0
+
+	def add(self, entry):
+		value = get_field(entry, self.field)
+		if value is not None:
+			self.total += value
+
+	def result(self):
+		return self.total * self.scale
+
+
+class TopNAccumulator(object):
+
+	def __init__(self, field, keep, n):
+		self.field = field
+		self.keep = keep
+		self.n = n
+		self.heap = []
+		self.added = 0
+
+	def add(self, entry):
+		value = get_field(entry, self.field)
+		if value is None:
+			return
+		# the counter breaks ties so entries themselves are never compared
+		self.added += 1
+		item = (value, self.added, dict((field, get_field(entry, field)) for field in (self.field,) + self.keep))
+		if len(self.heap) < self.n:
+			heapq.heappush(self.heap, item)
+		elif value > self.heap[0][0]:
+			heapq.heapreplace(self.heap, item)
+
+	def result(self):
+		return [kept for value, added, kept in sorted(self.heap, key=lambda item: item[0], reverse=True)]
+
+
+class HistogramAccumulator(object):
+
+	def __init__(self, field, bounds):
+		self.field = field
+		self.bounds = bounds
+		self.counts = [0] * len(bounds)
+
+	def add(self, entry):
+		value = get_field(entry, self.field)
+		if value is None:
+			return
+		# values below the first bound are counted in the first bucket
+		self.counts[max(bisect.bisect_right(self.bounds, value) - 1, 0)] += 1
+
+	def result(self):
+		return list(self.counts)
+
+
+class HeavyHittersAccumulator(object):
+
+	def __init__(self, field, capacity):
+		self.field = field
+		self.summary = SpaceSaving(capacity)
+
+	def add(self, entry):
+		value = get_field(entry, self.field)
+		if value is not None:
+			# sketches are stored as JSON, whose keys are strings
+			self.summary.add(str(value))
+
+	def result(self):
+		return self.summary.top(self.summary.capacity)
+
+	def sketch(self):
+		return self.summary
+
+
+class MeasureSet(object):
+	"""Running accumulators for a list of measures, fed one entry at a time."""
+
+	def __init__(self, measures):
+		self.measures = list(measures)
+		self.accumulators = [measure.accumulator() for measure in self.measures]
+		# route each entry only to the measures that can select its event type
+		self._by_event_type = {}
+		self._any_event_type = []
+		for measure, accumulator in zip(self.measures, self.accumulators):
+			if measure.event_types is None:
+				self._any_event_type.append((measure, accumulator))
+			else:
+				for event_type in measure.event_types:
+					self._by_event_type.setdefault(event_type, []).append((measure, accumulator))
+
+	def add(self, entry):
+		for measure, accumulator in self._by_event_type.get(entry.get('event_type'), ()):
+			if measure.matches(entry):
+				accumulator.add(entry)
+		for measure, accumulator in self._any_event_type:
+			if measure.matches(entry):
+				accumulator.add(entry)
+
+	def add_all(self, entries):
+		for entry in entries:
+			self.add(entry)
+
+	def result(self, name):
+		for measure, accumulator in zip(self.measures, self.accumulators):
+			if measure.name == name:
+				return accumulator.result()
+		raise KeyError(name)
+
+	def stats(self):
+		"""Return the (Stat measure, value) rows of every measure."""
+		rows = []
+		for measure, accumulator in zip(self.measures, self.accumulators):
+			rows.extend(measure.stats(accumulator.result()))
+		return rows
+
+	def sketches(self):
+		"""Return the (measure, sketch) of every measure that keeps a sketch."""
+		return [(measure.name, accumulator.sketch()) for measure, accumulator in zip(self.measures, self.accumulators)
+			if measure.sketch is not None]
+
+
+class MinuteBuckets(object):
+	"""A MeasureSet per minute of [starting, ending), filled from events by their created_at."""
+
+	def __init__(self, measures, starting, ending):
+		self.measures = list(measures)
+		self.starting = starting
+		self.ending = ending
+		self.buckets = {}
+
+	def add(self, event):
+		created_at = parse_timestamp(event['created_at'])
+		if created_at < self.starting or created_at >= self.ending:
+			return
+		minute = created_at.replace(second=0, microsecond=0)
+		bucket = self.buckets.get(minute)
+		if bucket is None:
+			bucket = self.buckets[minute] = MeasureSet(self.measures)
+		bucket.add(event)
+
+	def add_all(self, events):
+		for event in events:
+			self.add(event)
+
+	def rows(self):
+		"""Yield (measure, value, starting, ending) for every minute in the range, including empty minutes."""
+		empty = MeasureSet(self.measures).stats()
+		minute = self.starting
+		while minute < self.ending:
+			bucket = self.buckets.get(minute)
+			results = empty if bucket is None else bucket.stats()
+			next_minute = minute + datetime.timedelta(minutes=1)
+			for measure, value in results:
+				yield measure, value, minute, next_minute
+			minute = next_minute
+
+	def sketch_rows(self):
+		"""Yield (measure, sketch, starting, ending) for every minute that has events."""
+		for minute in sorted(self.buckets):
+			next_minute = minute + datetime.timedelta(minutes=1)
+			for measure, sketch in self.buckets[minute].sketches():
+				yield measure, sketch, minute, next_minute
+
+
+_timestamp = re.compile(r'^(\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2})(\.\d+)?(Z|[+-]\d{2}:?\d{2})?$')
+
+
+def parse_timestamp(value):
+	"""Parse a Box ISO 8601 timestamp such as '2015-10-06T10:12:03-07:00' into an aware UTC datetime."""
+	match = _timestamp.match(value)
+	if match is None:
+		raise ValueError('Unrecognized timestamp {0!r}'.format(value))
+	timestamp = datetime.datetime.strptime(match.group(1), '%Y-%m-%dT%H:%M:%S')
+	offset = match.group(3)
+	if offset and offset != 'Z':
+		delta = datetime.timedelta(hours=int(offset[1:3]), minutes=int(offset[-2:]))
+		timestamp = timestamp - delta if offset[0] == '+' else timestamp + delta
+	return timestamp.replace(tzinfo=datetime.timezone.utc)
+
+
+def event_types(measures):
+	"""The event types to request from Box for these measures; an empty list means all types."""
+	types = set()
+	for measure in measures:
+		if measure.event_types is None:
+			return []
+		types |= measure.event_types
+	return sorted(types)
+
+
+def fields(measures):
+	"""The top-level entry fields to request from Box for these measures."""
+	return sorted(set(field.split('.')[0] for measure in measures for field in measure.fields))
+
+
+def rollups():
+	"""{Stat measure: rollup kind} for every registered measure that rolls up."""
+	kinds = {}
+	for measure in velocity_measures + usage_measures:
+		if measure.rollup is not None:
+			for name in measure.stat_names():
+				kinds[name] = measure.rollup
+	return kinds
+
+
+def sketch_types():
+	"""{measure: sketch class} for every registered measure that keeps a sketch."""
+	return dict((measure.name, measure.sketch) for measure in velocity_measures + usage_measures if measure.sketch is not None)
+
+
+velocity_event_types = ['UPLOAD', 'DOWNLOAD', 'DELETE', 'COLLABORATION_INVITE', 'COLLABORATION_ACCEPT', 'LOGIN']
+
+# computed from admin_logs events once per minute
+velocity_measures = [Count(event_type, event_type=event_type) for event_type in velocity_event_types] + [
+	DistinctCount('UNIQUE_USERS', 'created_by.login', event_type=velocity_event_types, sketch=True),
+	HeavyHitters('TOP_DOWNLOADERS', 'created_by.login', event_type='DOWNLOAD'),
+	HeavyHitters('TOP_UPLOADERS', 'created_by.login', event_type='UPLOAD'),
+	HeavyHitters('HOT_FILES', 'source.item_id', event_type=['DOWNLOAD', 'UPLOAD']),
+]
+
+# computed from the enterprise user directory once an hour; these are gauges, so they roll up to the latest value
+usage_measures = [
+	Count('ACTIVE_USERS', where={'status': 'active'}, rollup='last'),
+	Count('INACTIVE_USERS', where={'status': 'inactive'}, rollup='last'),
+	Sum('STORAGE_USED_GB', 'space_used', scale=1.0 / (1024 * 1024 * 1024), rollup='last'),
+	TopN('TOP_STORAGE_USERS', 'space_used', keep=('id', 'login'), n=20),
+	Histogram('STORAGE_HISTOGRAM', 'space_used', [
+		('0', 0),
+		('1MB', 1024 ** 2),
+		('10MB', 10 * 1024 ** 2),
+		('100MB', 100 * 1024 ** 2),
+		('1GB', 1024 ** 3),
+		('10GB', 10 * 1024 ** 3),
+		('100GB', 100 * 1024 ** 3),
+		('1TB', 1024 ** 4),
+	], rollup='last'),
+]
@@ -33,4 +33,160 @@ class Stat(db.Model):
 		self.measure = measure
 		self.value = value
 		self.starting = starting
-		self.ending = ending
\ No newline at end of file
+		self.ending = ending
+		
+		
+class Checkpoint(db.Model):
+	
+	__tablename__ = 'checkpoints'
+	__table_args__ = (UniqueConstraint('enterprise_id', 'stream_type'),)
+
+	id = db.Column(db.Integer, primary_key=True)
+	enterprise_id = db.Column(db.String, nullable=False)
+	stream_type = db.Column(db.String, nullable=False)
+	stream_position = db.Column(db.String, nullable=False)
+	updated = db.Column(db.DateTime, nullable=False)
+	
+	def __init__(self, enterprise_id, stream_type, stream_position):
+		self.enterprise_id = enterprise_id
+		self.stream_type = stream_type
+		self.stream_position = stream_position
+		self.updated = datetime.datetime.utcnow()
+
+		
+		
+class BackfillSlice(db.Model):
+	
+	__tablename__ = 'backfill_slices'
+	__table_args__ = (UniqueConstraint('starting', 'ending'),)
+
+	id = db.Column(db.Integer, primary_key=True)
+	starting = db.Column(db.DateTime, nullable=False)
+	ending = db.Column(db.DateTime, nullable=False)
+	completed = db.Column(db.DateTime, nullable=False)
+	
+	def __init__(self, starting, ending):
+		self.starting = starting
+		self.ending = ending
+		self.completed = datetime.datetime.utcnow()
+
+		
+		
+class UserUsage(db.Model):
+	
+	__tablename__ = 'user_usage'
+	__table_args__ = (UniqueConstraint('user_id', 'recorded'),)
+
+	# one row per user per run in which the user's status or space_used changed
+	id = db.Column(db.Integer, primary_key=True)
+	user_id = db.Column(db.String, nullable=False)
+	status = db.Column(db.String, nullable=False)
+	space_used = db.Column(db.BigInteger, nullable=False)
+	recorded = db.Column(db.DateTime, nullable=False)
+	
+	def __init__(self, user_id, status, space_used, recorded):
+		self.user_id = user_id
+		self.status = status
+		self.space_used = space_used
+		self.recorded = recorded
+
+		
+		
+class UserSeen(db.Model):
+	
+	__tablename__ = 'user_seen'
+	__table_args__ = (UniqueConstraint('user_id'),)
+
+	# when each user was last listed in the enterprise directory; users missing from a run are deleted
+	id = db.Column(db.Integer, primary_key=True)
+	user_id = db.Column(db.String, nullable=False)
+	seen = db.Column(db.DateTime, nullable=False)
+	
+	def __init__(self, user_id, seen):
+		self.user_id = user_id
+		self.seen = seen
+
+		
+		
+class TopUser(db.Model):
+	
+	__tablename__ = 'top_users'
+	__table_args__ = (UniqueConstraint('starting', 'rank'),)
+
+	id = db.Column(db.Integer, primary_key=True)
+	starting = db.Column(db.DateTime, nullable=False)
+	rank = db.Column(db.Integer, nullable=False)
+	user_id = db.Column(db.String, nullable=False)
+	login = db.Column(db.String)
+	space_used = db.Column(db.BigInteger, nullable=False)
+	
+	def __init__(self, starting, rank, user_id, login, space_used):
+		self.starting = starting
+		self.rank = rank
+		self.user_id = user_id
+		self.login = login
+		self.space_used = space_used
+
+		
+		
+class StatRollup(db.Model):
+	
+	__tablename__ = 'stat_rollups'
+	__table_args__ = (UniqueConstraint('resolution', 'measure', 'starting'),)
+
+	# Stat values combined per hour, day or week; kept up to date as minute rows are written
+	id = db.Column(db.Integer, primary_key=True)
+	resolution = db.Column(db.String, nullable=False)
+	measure = db.Column(db.String, nullable=False)
+	value = db.Column(db.Float, nullable=False)
+	starting = db.Column(db.DateTime, nullable=False)
+	ending = db.Column(db.DateTime, nullable=False)
+	# the latest Stat.starting folded in, which decides the value of 'last' rollups
+	last_starting = db.Column(db.DateTime, nullable=False)
+	
+	def __init__(self, resolution, measure, value, starting, ending, last_starting):
+		self.resolution = resolution
+		self.measure = measure
+		self.value = value
+		self.starting = starting
+		self.ending = ending
+		self.last_starting = last_starting
+
+
+class StatWindow(db.Model):
+	
+	__tablename__ = 'stat_windows'
+	__table_args__ = (UniqueConstraint('starting', 'ending'),)
+
+	# the wide layout (STAT_LAYOUT=wide): every measure of a window in one row instead of one Stat row each
+	id = db.Column(db.Integer, primary_key=True)
+	starting = db.Column(db.DateTime, nullable=False)
+	ending = db.Column(db.DateTime, nullable=False)
+	# JSON object of {measure: value}
+	measures = db.Column(db.Text, nullable=False)
+	
+	def __init__(self, starting, ending, measures):
+		self.starting = starting
+		self.ending = ending
+		self.measures = measures
+
+
+class Sketch(db.Model):
+	
+	__tablename__ = 'sketches'
+	__table_args__ = (UniqueConstraint('resolution', 'measure', 'starting'),)
+
+	# a measure's serialized sketch (see sketches.py) per minute, and merged per hour, day and week
+	id = db.Column(db.Integer, primary_key=True)
+	resolution = db.Column(db.String, nullable=False)
+	measure = db.Column(db.String, nullable=False)
+	sketch = db.Column(db.LargeBinary, nullable=False)
+	starting = db.Column(db.DateTime, nullable=False)
+	ending = db.Column(db.DateTime, nullable=False)
+	
+	def __init__(self, resolution, measure, sketch, starting, ending):
+		self.resolution = resolution
+		self.measure = measure
+		self.sketch = sketch
+		self.starting = starting
+		self.ending = ending
@@ -0,0 +1,148 @@
+# partitions.py
+
+# Monthly range partitions of the stats table (STAT_PARTITIONS=True, PostgreSQL only). The table is
+# partitioned on `starting`, so range reads only touch the months they cover, and retention drops
+# whole months instead of deleting rows one by one.
+
+import re
+import datetime
+import threading
+from sqlalchemy import text
+from app import app, db
+
+table = 'stats'
+
+# created by create_db.py instead of db.create_all(); the primary key must include the partition key
+ddl = (
+	'CREATE TABLE {0} ('
+	'id SERIAL NOT NULL, '
+	'measure VARCHAR NOT NULL, '
+	'value FLOAT NOT NULL, '
+	'starting TIMESTAMP WITHOUT TIME ZONE NOT NULL, '
+	'ending TIMESTAMP WITHOUT TIME ZONE NOT NULL, '
+	'PRIMARY KEY (id, starting), '
+	'UNIQUE (measure, starting)'
+	') PARTITION BY RANGE (starting)')
+
+_name = re.compile(r'^' + table + r'_(\d{4})_(\d{2})$')
+_known = set()
+_lock = threading.Lock()
+
+
+def enabled():
+	return bool(app.config.get('STAT_PARTITIONS')) and db.engine.dialect.name == 'postgresql'
+
+
+def month(value):
+	return datetime.datetime(value.year, value.month, 1)
+
+
+def next_month(value):
+	return datetime.datetime(value.year + value.month // 12, value.month % 12 + 1, 1)
+
+
+def partition_name(starting):
+	return '{0}_{1:04d}_{2:02d}'.format(table, starting.year, starting.month)
+
+
+def partitioned(session=None):
+	"""True when the stats table exists and is partitioned."""
+	session = db.session if session is None else session
+	return session.execute(text('SELECT relkind FROM pg_class WHERE relname = :table'), {'table': table}).scalar() == 'p'
+
+
+def partitions(session=None):
+	"""{month: partition name} of the partitions attached to the stats table."""
+	session = db.session if session is None else session
+	names = session.execute(text(
+		'SELECT child.relname FROM pg_inherits '
+		'JOIN pg_class parent ON parent.oid = pg_inherits.inhparent '
+		'JOIN pg_class child ON child.oid = pg_inherits.inhrelid '
+		'WHERE parent.relname = :table'), {'table': table})
+	found = {}
+	for name, in names:
+		match = _name.match(name)
+		if match:
+			found[datetime.datetime(int(match.group(1)), int(match.group(2)), 1)] = name
+	return found
+
+
+def ensure_partitions(starting, ending):
+	"""Create and commit the missing monthly partitions covering [starting, ending)."""
+	wanted = [current for current in months(starting, ending) if current not in _known]
+	if not wanted:
+		return
+	with _lock:
+		try:
+			create_partitions(wanted)
+			db.session.commit()
+		except:
+			db.session.rollback()
+			raise
+		# only remembered once committed, so a failed attempt is retried on the next write
+		_known.update(wanted)
+
+
+def create_partitions(wanted, session=None):
+	"""Create the missing monthly partitions starting at `wanted`, through `session` (or connection) when given."""
+	session = db.session if session is None else session
+	existing = partitions(session)
+	for starting in wanted:
+		if starting not in existing:
+			session.execute(text(
+				"CREATE TABLE IF NOT EXISTS {0} PARTITION OF {1} FOR VALUES FROM ('{2}') TO ('{3}')".format(
+					partition_name(starting), table, starting.isoformat(' '), next_month(starting).isoformat(' '))))
+
+
+def months(starting, ending):
+	current = month(starting.replace(tzinfo=None))
+	while current < ending.replace(tzinfo=None):
+		yield current
+		current = next_month(current)
+
+
+def create_partitioned_table():
+	"""
+	Create the stats table partitioned by month, or convert an existing unpartitioned one: its rows
+	are copied into a new partitioned table in one transaction and the old table is dropped.
+	"""
+	kind = db.session.execute(text('SELECT relkind FROM pg_class WHERE relname = :table'), {'table': table}).scalar()
+	if kind == 'p':
+		return
+	try:
+		if kind is None:
+			db.session.execute(text(ddl.format(table)))
+		else:
+			db.session.execute(text('ALTER TABLE {0} RENAME TO {0}_unpartitioned'.format(table)))
+			db.session.execute(text(ddl.format(table)))
+			oldest, newest = db.session.execute(text('SELECT min(starting), max(starting) FROM {0}_unpartitioned'.format(table))).first()
+			if oldest is not None:
+				create_partitions(list(months(oldest, newest + datetime.timedelta(minutes=1))))
+			db.session.execute(text(
+				'INSERT INTO {0} (id, measure, value, starting, ending) '
+				'SELECT id, measure, value, starting, ending FROM {0}_unpartitioned'.format(table)))
+			db.session.execute(text(
+				"SELECT setval(pg_get_serial_sequence('{0}', 'id'), coalesce((SELECT max(id) FROM {0}), 0) + 1, false)".format(table)))
+			db.session.execute(text('DROP TABLE {0}_unpartitioned'.format(table)))
+		now = datetime.datetime.utcnow()
+		create_partitions(list(months(now, next_month(next_month(now)))))
+		db.session.commit()
+	except:
+		db.session.rollback()
+		raise
+
+
+def drop_partitions(before):
+	"""Drop the monthly partitions that end on or before `before`; returns their names."""
+	dropped = []
+	try:
+		for starting, name in sorted(partitions().items()):
+			if next_month(starting) <= before.replace(tzinfo=None):
+				db.session.execute(text('DROP TABLE {0}'.format(name)))
+				_known.discard(starting)
+				dropped.append(name)
+		db.session.commit()
+	except:
+		db.session.rollback()
+		raise
+	return dropped
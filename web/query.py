@@ -0,0 +1,234 @@
+# query.py
+
+# Columnar, NumPy-backed queries over the local event archive. Each hourly archive partition is
+# loaded as dictionary-encoded arrays (cached next to it as .npz), and filters and group-bys run
+# as array operations instead of per-event Python loops.
+
+import os
+import calendar
+import numpy as np
+from measures import Count, DistinctCount, parse_timestamp
+
+# query column -> dotted field of the archived event
+columns = {
+	'event_type': 'event_type',
+	'login': 'created_by.login',
+	'ip_address': 'ip_address',
+	'item_id': 'source.item_id',
+	'item_type': 'source.item_type',
+	'source_id': 'source.id',
+}
+
+# time bucket -> width in seconds; weeks are aligned to Monday
+buckets = {
+	'minute': 60,
+	'hour': 3600,
+	'day': 86400,
+	'week': 7 * 86400,
+}
+_week_offset = 3 * 86400  # 1970-01-01 was a Thursday, so weeks start 4 days into the epoch
+
+
+def epoch(value):
+	return calendar.timegm(value.utctimetuple())
+
+
+def column_for(field):
+	for name, dotted in columns.items():
+		if dotted == field or name == field:
+			return name
+	raise KeyError('{0} is not an archived column'.format(field))
+
+
+def unique_rows(columns, sizes, length):
+	"""
+	The distinct rows of equal-length int64 columns (column i in [0, sizes[i])) and how often each
+	occurs, as (rows matrix, counts). Rows are packed into one int64 key when they fit, and compared
+	whole otherwise.
+	"""
+	if not columns:
+		# no grouping: everything is one group, or none when empty
+		return np.zeros((1 if length else 0, 0), dtype=np.int64), np.array([length] if length else [], dtype=np.int64)
+	sizes = [max(size, 1) for size in sizes]
+	total = 1
+	for size in sizes:
+		total *= size
+	if total > np.iinfo(np.int64).max:
+		return np.unique(np.column_stack(columns), axis=0, return_counts=True)
+	keys = np.zeros(length, dtype=np.int64)
+	for column, size in zip(columns, sizes):
+		keys = keys * size + column
+	keys, counts = np.unique(keys, return_counts=True)
+	digits = []
+	for size in reversed(sizes):
+		keys, digit = np.divmod(keys, size)
+		digits.append(digit)
+	return np.column_stack(list(reversed(digits))), counts
+
+
+class EventFrame(object):
+	"""
+	A set of events as arrays: created_at as int64 epoch seconds, and each column in `columns`
+	as int32 codes into a list of categories (code -1 is a missing value).
+	"""
+
+	def __init__(self, created_at, codes, categories):
+		self.created_at = created_at
+		self.codes = codes
+		self.categories = categories
+
+	def __len__(self):
+		return len(self.created_at)
+
+	@classmethod
+	def from_records(cls, records):
+		created_at = []
+		values = dict((name, []) for name in columns)
+		for record in records:
+			created_at.append(epoch(parse_timestamp(record['created_at'])))
+			for name, field in columns.items():
+				value = record
+				for part in field.split('.'):
+					value = value.get(part) if isinstance(value, dict) else None
+				values[name].append(value)
+		codes = {}
+		categories = {}
+		for name, column in values.items():
+			index = {}
+			column_codes = np.empty(len(column), dtype=np.int32)
+			for i, value in enumerate(column):
+				column_codes[i] = -1 if value is None else index.setdefault(value, len(index))
+			codes[name] = column_codes
+			categories[name] = sorted(index, key=index.get)
+		return cls(np.array(created_at, dtype=np.int64), codes, categories)
+
+	@classmethod
+	def concat(cls, frames):
+		"""Join frames, re-mapping each frame's codes into one shared set of categories."""
+		frames = [frame for frame in frames if len(frame)]
+		if not frames:
+			return cls.from_records([])
+		codes = {}
+		categories = {}
+		for name in columns:
+			index = {}
+			parts = []
+			for frame in frames:
+				mapping = np.array([index.setdefault(value, len(index)) for value in frame.categories[name]] + [-1], dtype=np.int32)
+				# code -1 indexes the trailing -1 in mapping, so missing values stay missing
+				parts.append(mapping[frame.codes[name]])
+			codes[name] = np.concatenate(parts)
+			categories[name] = sorted(index, key=index.get)
+		return cls(np.concatenate([frame.created_at for frame in frames]), codes, categories)
+
+	def take(self, mask):
+		return EventFrame(self.created_at[mask], dict((name, codes[mask]) for name, codes in self.codes.items()), self.categories)
+
+	def between(self, starting, ending):
+		return self.take((self.created_at >= epoch(starting)) & (self.created_at < epoch(ending)))
+
+	def where(self, **equals):
+		"""Keep events whose column equals the value, or is one of the values when given a list."""
+		mask = np.ones(len(self), dtype=bool)
+		for name, wanted in equals.items():
+			wanted = wanted if isinstance(wanted, (list, tuple, set, frozenset)) else [wanted]
+			# a lookup table indexed by code + 1, so missing values (-1) land on slot 0
+			selected = np.zeros(len(self.categories[name]) + 1, dtype=bool)
+			for code, value in enumerate(self.categories[name]):
+				if value in wanted:
+					selected[code + 1] = True
+			mask &= selected[self.codes[name] + 1]
+		return self.take(mask)
+
+	def _group_columns(self, by, bucket):
+		# one non-negative int64 column per group level, with the number of values it can take
+		columns = []
+		labels = []
+		if bucket is not None:
+			width = buckets[bucket]
+			column = (self.created_at + _week_offset) // width if bucket == 'week' else self.created_at // width
+			columns.append(column)
+			labels.append(('bucket', int(column.max()) + 1 if len(column) else 1))
+		for name in by:
+			columns.append(self.codes[name].astype(np.int64) + 1)
+			labels.append((name, len(self.categories[name]) + 1))
+		return columns, labels
+
+	def _decode(self, groups, labels, bucket):
+		rows = []
+		for group in groups.tolist():
+			row = []
+			for (name, size), value in zip(labels, group):
+				if name == 'bucket':
+					row.append((value * buckets[bucket] - (_week_offset if bucket == 'week' else 0)) * 1000)
+				else:
+					row.append(None if value == 0 else self.categories[name][value - 1])
+			rows.append(row)
+		return rows
+
+	def count(self, by=(), bucket=None):
+		"""Return [group values..., count] rows; a time bucket is given as its start in ms since epoch."""
+		columns, labels = self._group_columns(by, bucket)
+		groups, counts = unique_rows(columns, [size for name, size in labels], len(self))
+		return [row + [count] for row, count in zip(self._decode(groups, labels, bucket), counts.tolist())]
+
+	def distinct(self, column, by=(), bucket=None):
+		"""Return [group values..., number of distinct non-missing values of column] rows."""
+		frame = self.take(self.codes[column] >= 0)
+		columns, labels = frame._group_columns(by, bucket)
+		sizes = [size for name, size in labels]
+		# the distinct (group, value) pairs first, then how many pairs each group has
+		pairs, _ = unique_rows(columns + [frame.codes[column].astype(np.int64)], sizes + [len(frame.categories[column])], len(frame))
+		groups, counts = unique_rows([pairs[:, i] for i in range(len(columns))], sizes, len(pairs))
+		return [row + [count] for row, count in zip(frame._decode(groups, labels, bucket), counts.tolist())]
+
+	def measure(self, measure, bucket='minute'):
+		"""Evaluate a Count or DistinctCount measure per time bucket, as {bucket start epoch seconds: value}."""
+		frame = self
+		if measure.event_types is not None:
+			frame = frame.where(event_type=list(measure.event_types))
+		if measure.where:
+			frame = frame.where(**dict((column_for(field), value) for field, value in measure.where.items()))
+		if isinstance(measure, DistinctCount):
+			rows = frame.distinct(column_for(measure.field), bucket=bucket)
+		elif isinstance(measure, Count):
+			rows = frame.count(bucket=bucket)
+		else:
+			raise ValueError('{0} cannot be evaluated over archived columns'.format(measure))
+		return dict((tick // 1000, value) for tick, value in rows)
+
+
+class EventQuery(object):
+	"""Loads archive partitions as EventFrames."""
+
+	def __init__(self, archive):
+		self.archive = archive
+
+	def partition(self, filename):
+		cache = filename[:-len('.jsonl.gz')] + '.npz'
+		if os.path.exists(cache) and os.path.getmtime(cache) >= os.path.getmtime(filename):
+			with np.load(cache) as arrays:
+				return EventFrame(
+					arrays['created_at'],
+					dict((name, arrays['codes_' + name]) for name in columns),
+					dict((name, arrays['categories_' + name].tolist()) for name in columns))
+		seen = set()
+		records = []
+		for record in self.archive.records(filename):
+			if record['event_id'] not in seen:
+				seen.add(record['event_id'])
+				records.append(record)
+		frame = EventFrame.from_records(records)
+		arrays = {'created_at': frame.created_at}
+		for name in columns:
+			arrays['codes_' + name] = frame.codes[name]
+			arrays['categories_' + name] = np.array(frame.categories[name], dtype=np.str_)
+		# written aside and renamed so a concurrent reader never sees half a cache file
+		with open(cache + '.tmp', 'wb') as out:
+			np.savez_compressed(out, **arrays)
+		os.rename(cache + '.tmp', cache)
+		return frame
+
+	def load(self, starting, ending):
+		frames = [self.partition(filename) for hour, filename in self.archive.hours(starting, ending)]
+		return EventFrame.concat(frames).between(starting, ending)
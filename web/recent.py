@@ -0,0 +1,120 @@
+# recent.py
+
+import time
+import calendar
+import threading
+import numpy as np
+from app import app
+
+
+def minute_of(value):
+	"""Minutes since the epoch of a naive UTC or aware datetime."""
+	return calendar.timegm(value.utctimetuple()) // 60
+
+
+class SeriesBuffer(object):
+	"""
+	The values of one measure for the last `capacity` minutes, in two fixed-size arrays indexed by
+	minute modulo `capacity`. Writing a minute overwrites whatever older minute shared its slot, so
+	the buffer never grows and a rewritten minute simply replaces its value.
+	"""
+
+	def __init__(self, capacity):
+		self.capacity = capacity
+		# minute held by each slot, -1 while empty
+		self.minutes = np.full(capacity, -1, dtype=np.int64)
+		self.values = np.zeros(capacity, dtype=np.float64)
+
+	def put(self, minute, value):
+		slot = minute % self.capacity
+		self.values[slot] = value
+		self.minutes[slot] = minute
+
+	def points(self, starting, ending):
+		"""[tick (ms from epoch), value] of the stored minutes in [starting, ending), oldest first."""
+		wanted = np.arange(max(starting, ending - self.capacity), ending, dtype=np.int64)
+		slots = wanted % self.capacity
+		held = self.minutes[slots] == wanted
+		ticks = (wanted[held] * 60000).astype(np.float64)
+		return np.column_stack((ticks, self.values[slots][held])).tolist()
+
+
+class RecentSeries(object):
+	"""
+	Per-measure SeriesBuffers of the last `days` of stats, so the charts' polling reads recent
+	points without reading the stats. Seeded from the database, then kept current by every stat
+	write of this process. Reads from before what the buffers cover return None.
+
+	`version` is the database's stats version the buffers reflect. Every stat write replaces that
+	version, so a different one in the database means another process (a backfill, another worker)
+	has written stats since, and the buffers need seeding again. Comparing costs a query, so it is
+	done at most once every `check_seconds`: other processes' writes show up that much later, and
+	reads in between touch no database at all.
+	"""
+
+	def __init__(self, days=7, check_seconds=30):
+		self.capacity = int(days * 24 * 60)
+		self.check_seconds = check_seconds
+		self.checked = None
+		self.buffers = {}
+		# first minute the buffers are complete from; None until seeded
+		self.oldest = None
+		self.newest = None
+		self.version = None
+		self.lock = threading.Lock()
+
+	def seed(self, rows, starting, version):
+		"""Refill the buffers from stored (measure, value, starting, ending) rows from `starting` on."""
+		if self.capacity <= 0:
+			return
+		with self.lock:
+			self.buffers = {}
+			self.newest = None
+			self.put(rows)
+			self.oldest = minute_of(starting)
+			self.version = version
+			self.checked = time.monotonic()
+
+	def add(self, rows, previous, version):
+		"""Put rows written by this process, which moved the stats version from `previous` to `version`."""
+		if self.capacity <= 0:
+			return
+		with self.lock:
+			self.put(rows)
+			# otherwise some other write was missed, and the version stays stale until the next seed
+			if self.version == previous:
+				self.version = version
+
+	def put(self, rows):
+		for measure, value, starting, ending in rows:
+			if measure not in self.buffers:
+				self.buffers[measure] = SeriesBuffer(self.capacity)
+			minute = minute_of(starting)
+			self.buffers[measure].put(minute, value)
+			if self.newest is None or minute > self.newest:
+				self.newest = minute
+
+	def due(self):
+		"""True (once) when the version should be compared with the database's again."""
+		with self.lock:
+			if self.oldest is None or time.monotonic() - self.checked < self.check_seconds:
+				return False
+			self.checked = time.monotonic()
+			return True
+
+	def covers(self, starting):
+		if self.oldest is None or self.newest is None:
+			return False
+		return minute_of(starting) >= max(self.oldest, self.newest - self.capacity + 1)
+
+	def series(self, measure, starting):
+		"""A measure's [tick, value] points from `starting` on, or None when the buffers do not cover it."""
+		with self.lock:
+			if not self.covers(starting):
+				return None
+			if measure not in self.buffers:
+				return []
+			return self.buffers[measure].points(minute_of(starting), self.newest + 1)
+
+
+cache = RecentSeries(app.config.get('RECENT_SERIES_DAYS', 7), app.config.get('RECENT_SERIES_CHECK_SECONDS', 30))
@@ -0,0 +1,126 @@
+# sketches.py
+
+# Small, mergeable summaries of a minute's events, stored next to its Stat rows. Sketches of any
+# set of minutes merge into a sketch of their union, so a distinct count or the busiest users over
+# an hour, a day or a month never need the events again.
+
+import json
+import math
+import zlib
+import hashlib
+import numpy as np
+
+
+def hash64(value):
+	"""A 64-bit hash of a value's text that is the same in every process (unlike hash())."""
+	return int.from_bytes(hashlib.sha1(str(value).encode('utf-8')).digest()[:8], 'big')
+
+
+class HyperLogLog(object):
+	"""
+	Approximate distinct count in 2 ** p one-byte registers. With the default p=11 a sketch is 2 KB
+	uncompressed and estimates are within about 2.3% (one standard error).
+	"""
+
+	def __init__(self, p=11, registers=None):
+		self.p = p
+		self.registers = np.zeros(1 << p, dtype=np.uint8) if registers is None else registers
+
+	def add(self, value):
+		x = hash64(value)
+		index = x >> (64 - self.p)
+		rest = x & ((1 << (64 - self.p)) - 1)
+		# position of the first 1 bit in the remaining 64 - p bits
+		rank = (64 - self.p) - rest.bit_length() + 1
+		if rank > self.registers[index]:
+			self.registers[index] = rank
+
+	def update(self, values):
+		for value in values:
+			self.add(value)
+		return self
+
+	def merge(self, other):
+		if other.p != self.p:
+			raise ValueError('Cannot merge sketches of precision {0} and {1}'.format(self.p, other.p))
+		np.maximum(self.registers, other.registers, out=self.registers)
+		return self
+
+	def count(self):
+		m = float(len(self.registers))
+		alpha = 0.7213 / (1 + 1.079 / m)
+		estimate = alpha * m * m / np.sum(np.power(2.0, -self.registers.astype(np.float64)))
+		zeros = int(np.count_nonzero(self.registers == 0))
+		if estimate <= 2.5 * m and zeros:
+			# linear counting is more accurate while most registers are still empty
+			estimate = m * math.log(m / zeros)
+		return int(round(estimate))
+
+	def to_bytes(self):
+		# registers of a quiet minute are nearly all zero and compress to a few dozen bytes
+		return zlib.compress(bytes([self.p]) + self.registers.tobytes())
+
+	@classmethod
+	def from_bytes(cls, data):
+		data = zlib.decompress(data)
+		return cls(data[0], np.frombuffer(data[1:], dtype=np.uint8).copy())
+
+
+class SpaceSaving(object):
+	"""
+	The most frequent items of a stream in at most `capacity` counters (Metwally et al.). An item not
+	tracked takes over the smallest counter, inheriting its count as `error`, so any item counted more
+	than total / capacity times is always kept and its true count lies in [count - error, count].
+	"""
+
+	def __init__(self, capacity=100, counters=None):
+		self.capacity = capacity
+		# item -> [count, error]
+		self.counters = {} if counters is None else counters
+
+	def add(self, item, weight=1):
+		counter = self.counters.get(item)
+		if counter is not None:
+			counter[0] += weight
+		elif len(self.counters) < self.capacity:
+			self.counters[item] = [weight, 0]
+		else:
+			smallest = min(self.counters, key=lambda key: self.counters[key][0])
+			count = self.counters.pop(smallest)[0]
+			self.counters[item] = [count + weight, count]
+
+	def update(self, items):
+		for item in items:
+			self.add(item)
+		return self
+
+	def floor(self):
+		# the most an untracked item can have been seen; 0 while there is room left
+		if len(self.counters) < self.capacity:
+			return 0
+		return min(count for count, error in self.counters.values())
+
+	def merge(self, other):
+		"""Combine with another summary (Agarwal et al.); items missing from one side get that side's floor."""
+		floor, other_floor = self.floor(), other.floor()
+		merged = {}
+		for item in set(self.counters) | set(other.counters):
+			count, error = self.counters.get(item, (floor, floor))
+			other_count, other_error = other.counters.get(item, (other_floor, other_floor))
+			merged[item] = [count + other_count, error + other_error]
+		self.capacity = max(self.capacity, other.capacity)
+		self.counters = dict(sorted(merged.items(), key=lambda entry: entry[1][0], reverse=True)[:self.capacity])
+		return self
+
+	def top(self, n=10):
+		"""[(item, count, error)] of the n largest counters, largest first."""
+		ranked = sorted(self.counters.items(), key=lambda entry: (-entry[1][0], entry[1][1]))
+		return [(item, count, error) for item, (count, error) in ranked[:n]]
+
+	def to_bytes(self):
+		return zlib.compress(json.dumps({'capacity': self.capacity, 'counters': self.counters}, separators=(',', ':')).encode('utf-8'))
+
+	@classmethod
+	def from_bytes(cls, data):
+		state = json.loads(zlib.decompress(data).decode('utf-8'))
+		return cls(state['capacity'], state['counters'])
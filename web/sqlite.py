@@ -0,0 +1,43 @@
+# sqlite.py
+
+# Settings for the embedded SQLite backend (DB_BACKEND=sqlite).
+
+import os
+import sqlite3
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# applied to every new connection; WAL lets the charts read while the background jobs write
+pragmas = (
+	('journal_mode', 'WAL'),
+	# WAL stays consistent with NORMAL; a power loss can only lose the last few commits
+	('synchronous', 'NORMAL'),
+	# wait for the writer instead of failing with "database is locked"
+	('busy_timeout', 5000),
+	('cache_size', -64000),
+	('temp_store', 'MEMORY'),
+	('mmap_size', 256 * 1024 * 1024),
+)
+
+# INSERT ... ON CONFLICT DO UPDATE, used for every stat write, needs SQLite 3.24
+minimum_version = (3, 24, 0)
+
+
+@event.listens_for(Engine, 'connect')
+def set_pragmas(connection, record):
+	if not isinstance(connection, sqlite3.Connection):
+		return
+	cursor = connection.cursor()
+	for name, value in pragmas:
+		cursor.execute('PRAGMA {0} = {1}'.format(name, value))
+	cursor.close()
+
+
+def prepare(path):
+	"""Check the SQLite library and create the directory of the database file."""
+	if sqlite3.sqlite_version_info < minimum_version:
+		raise RuntimeError('DB_BACKEND=sqlite needs SQLite {0} or later, found {1}'.format(
+			'.'.join(str(part) for part in minimum_version), sqlite3.sqlite_version))
+	directory = os.path.dirname(os.path.abspath(path))
+	if not os.path.isdir(directory):
+		os.makedirs(directory)
@@ -0,0 +1,608 @@
+# store.py
+
+import json
+import uuid
+import datetime
+from sqlalchemy import text, func, bindparam, and_, or_
+from app import app, db
+from models import Setting, Stat, StatRollup, StatWindow, Sketch, UserUsage, UserSeen, TopUser
+from measures import rollups, sketch_types
+from sketches import SpaceSaving
+import partitions
+import recent
+
+# rows per INSERT statement; a run's rows still go out in one transaction
+batch_size = 1000
+# SQLite builds before 3.32 allow at most 999 bound parameters per statement
+sqlite_max_variables = 999
+
+
+# rollup resolutions kept next to the per-minute rows
+resolutions = ('hour', 'day', 'week')
+
+
+def wide():
+	"""True when stats are stored one row per window (STAT_LAYOUT=wide) rather than one row per measure."""
+	return app.config.get('STAT_LAYOUT', 'rows') == 'wide'
+
+
+def stat_model():
+	return StatWindow if wide() else Stat
+
+
+def upsert_stats(rows, sketches=()):
+	"""
+	Write (measure, value, starting, ending) rows to the stats table in a single transaction.
+
+	Each batch is one INSERT ... ON CONFLICT (measure, starting) DO UPDATE statement, so a retried
+	job overwrites its own rows instead of failing on the unique constraint, and rows whose value
+	did not change are left untouched. With STAT_LAYOUT=wide the rows are merged into stat_windows
+	instead. The hour, day and week rollups of the rows, and the (measure, sketch, starting, ending)
+	minute sketches, are written in the same transaction, which also bumps the stats version.
+	Rolls back and re-raises on error.
+	"""
+	rows = unique(rows, (0, 2))
+	sketches = unique(sketches, (0, 2))
+	if rows and not wide() and partitions.enabled():
+		partitions.ensure_partitions(min(row[2] for row in rows), max(row[2] for row in rows) + datetime.timedelta(minutes=1))
+	try:
+		if wide():
+			previous = upsert_windows(rows)
+		else:
+			previous = stat_values(rows)
+			execute_upsert('stats', ('measure', 'value', 'starting', 'ending'), ('measure', 'starting'), rows)
+		update_rollups(rows, previous)
+		upsert_sketches(sketches)
+		version = bump_stats_version()
+		db.session.commit()
+	except:
+		db.session.rollback()
+		raise
+	recent.cache.add(rows, *version)
+	return len(rows)
+
+
+def bump_stats_version():
+	"""Give the stats a new version, without committing; returns the (previous, new) versions."""
+	# locked until the commit, so the previous version is the one this write replaces
+	setting = Setting.query.filter(Setting.key == 'stats_version').order_by(Setting.id).with_for_update().first()
+	if setting is None:
+		setting = Setting('stats_version', '')
+		db.session.add(setting)
+	previous = setting.value or None
+	setting.value = uuid.uuid4().hex
+	return previous, setting.value
+
+
+def stats_version():
+	setting = Setting.query.filter(Setting.key == 'stats_version').order_by(Setting.id).first()
+	return None if setting is None else setting.value or None
+
+
+def upsert(table, columns, key, rows):
+	"""Insert or update rows (tuples in `columns` order) of `table`, whose unique constraint is on `key`."""
+	rows = unique(rows, [columns.index(column) for column in key])
+	try:
+		execute_upsert(table, columns, key, rows)
+		db.session.commit()
+	except:
+		db.session.rollback()
+		raise
+	return len(rows)
+
+
+def unique(rows, key):
+	# a statement may not touch the same key twice; the last row for a key wins
+	latest = {}
+	for row in rows:
+		row = tuple(naive(value) for value in row)
+		latest[tuple(row[index] for index in key)] = row
+	return list(latest.values())
+
+
+def execute_upsert(table, columns, key, rows, update=None, where='changed'):
+	"""
+	Run INSERT ... ON CONFLICT (key) DO UPDATE for rows, in batches, without committing.
+
+	`update` maps columns to SQL expressions (default: take the new value of every non-key column),
+	and `where` is the update's condition; by default only rows whose values change are updated.
+	"""
+	if update is None:
+		update = dict((column, 'EXCLUDED.{0}'.format(column)) for column in columns if column not in key)
+	if where == 'changed':
+		where = ' OR '.join('{0}.{1} <> EXCLUDED.{1}'.format(table, column) for column in update)
+	types = db.metadata.tables[table].c
+	size = batch_size
+	if db.engine.dialect.name == 'sqlite':
+		size = min(size, sqlite_max_variables // len(columns))
+	for offset in range(0, len(rows), size):
+		values = []
+		params = {}
+		binds = []
+		for i, row in enumerate(rows[offset:offset + size]):
+			values.append('({0})'.format(', '.join(':{0}_{1}'.format(column, i) for column in columns)))
+			for column, value in zip(columns, row):
+				params['{0}_{1}'.format(column, i)] = value
+				# bound with the column's type so values are stored exactly as the ORM would store them
+				binds.append(bindparam('{0}_{1}'.format(column, i), type_=types[column].type))
+		db.session.execute(text(
+			'INSERT INTO {table} ({columns}) VALUES {values} '
+			'ON CONFLICT ({key}) DO UPDATE SET {set}{where}'.format(
+				table=table,
+				columns=', '.join(columns),
+				values=', '.join(values),
+				key=', '.join(key),
+				set=', '.join('{0} = {1}'.format(column, expression) for column, expression in sorted(update.items())),
+				where=' WHERE ' + where if where else '')
+		).bindparams(*binds), params)
+
+
+def naive(value):
+	# the DateTime columns hold UTC without a zone; compare aware and stored values on that footing
+	if isinstance(value, datetime.datetime) and value.tzinfo is not None:
+		return value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+	return value
+
+
+def stat_values(rows):
+	"""The values currently stored for the (measure, starting) of rows, as {(measure, starting): value}."""
+	if not rows:
+		return {}
+	wanted = set((measure, naive(starting)) for measure, value, starting, ending in rows)
+	# locked until the commit so a concurrent writer of the same minutes cannot fold the same old values into the rollups
+	stats = db.session.query(Stat.measure, Stat.starting, Stat.value).filter(
+		Stat.measure.in_(set(measure for measure, starting in wanted)),
+		Stat.starting >= min(starting for measure, starting in wanted),
+		Stat.starting <= max(starting for measure, starting in wanted)).with_for_update()
+	return dict(((measure, starting), value) for measure, starting, value in stats if (measure, starting) in wanted)
+
+
+def upsert_windows(rows):
+	"""
+	Merge rows into their stat_windows rows, without committing. Measures already in a window and
+	not in rows are kept. Returns the values the rows replace, like stat_values.
+	"""
+	windows = {}
+	for measure, value, starting, ending in rows:
+		windows.setdefault((starting, ending), {})[measure] = float(value)
+	if not windows:
+		return {}
+	# locked until the commit so concurrent writers to a window merge one after the other
+	stored = dict(((window.starting, window.ending), json.loads(window.measures)) for window in StatWindow.query.filter(
+		StatWindow.starting >= min(starting for starting, ending in windows),
+		StatWindow.starting <= max(starting for starting, ending in windows)).with_for_update())
+	previous = {}
+	merged = []
+	for (starting, ending), values in windows.items():
+		measures = stored.get((starting, ending), {})
+		for measure in values:
+			if measure in measures:
+				previous[(measure, starting)] = measures[measure]
+		measures.update(values)
+		merged.append((starting, ending, json.dumps(measures, sort_keys=True)))
+	execute_upsert('stat_windows', ('starting', 'ending', 'measures'), ('starting', 'ending'), merged)
+	return previous
+
+
+def stat_rows(starting=None, ending=None, measures=None):
+	"""Yield stored (measure, value, starting, ending) rows of [starting, ending), oldest first, from either layout."""
+	model = stat_model()
+	query = model.query
+	if starting is not None:
+		query = query.filter(model.starting >= naive(starting))
+	if ending is not None:
+		query = query.filter(model.starting < naive(ending))
+	if not wide():
+		if measures is not None:
+			query = query.filter(Stat.measure.in_(list(measures)))
+		for stat in query.order_by(Stat.starting.asc(), Stat.measure.asc()):
+			yield stat.measure, stat.value, stat.starting, stat.ending
+		return
+	if measures is not None:
+		# a cheap prefilter; the JSON is still checked below
+		query = query.filter(or_(*[StatWindow.measures.like('%"{0}":%'.format(measure)) for measure in measures]))
+	for window in query.order_by(StatWindow.starting.asc()):
+		for measure, value in sorted(json.loads(window.measures).items()):
+			if measures is None or measure in measures:
+				yield measure, value, window.starting, window.ending
+
+
+def recorded_measures(names, starting, ending):
+	"""{starting: number of the named measures stored for it} for windows starting in [starting, ending)."""
+	if not wide():
+		return dict(db.session.query(Stat.starting, func.count(Stat.id)).filter(
+			Stat.measure.in_(names),
+			Stat.starting >= naive(starting),
+			Stat.starting < naive(ending)).group_by(Stat.starting).all())
+	counts = {}
+	for measure, value, stat_starting, stat_ending in stat_rows(starting, ending, names):
+		counts[stat_starting] = counts.get(stat_starting, 0) + 1
+	return counts
+
+
+def bucket(starting, resolution):
+	"""The (starting, ending) of the minute, hour, day, week or month holding a time; weeks start on Monday."""
+	if resolution == 'minute':
+		starting = starting.replace(second=0, microsecond=0)
+		return starting, starting + datetime.timedelta(minutes=1)
+	if resolution == 'hour':
+		starting = starting.replace(minute=0, second=0, microsecond=0)
+		return starting, starting + datetime.timedelta(hours=1)
+	starting = starting.replace(hour=0, minute=0, second=0, microsecond=0)
+	if resolution == 'day':
+		return starting, starting + datetime.timedelta(days=1)
+	if resolution == 'month':
+		return starting.replace(day=1), partitions.next_month(starting)
+	starting -= datetime.timedelta(days=starting.weekday())
+	return starting, starting + datetime.timedelta(days=7)
+
+
+def update_rollups(rows, previous):
+	"""
+	Fold freshly written minute rows into their rollups. 'sum' rollups add the change of each minute's
+	value (so rewriting a minute never counts it twice), and 'last' rollups keep the latest minute's value.
+	"""
+	kinds = rollups()
+	sums = {}
+	lasts = {}
+	for measure, value, starting, ending in rows:
+		kind = kinds.get(measure)
+		if kind not in ('sum', 'last'):
+			# 'sketch' rollups are written from the merged sketches by upsert_sketches
+			continue
+		starting = naive(starting)
+		for resolution in resolutions:
+			bucket_starting, bucket_ending = bucket(starting, resolution)
+			key = (resolution, measure, bucket_starting)
+			if kind == 'sum':
+				delta = value - previous.get((measure, starting), 0)
+				last_starting = max(starting, sums[key][5]) if key in sums else starting
+				sums[key] = (resolution, measure, (sums[key][2] if key in sums else 0) + delta, bucket_starting, bucket_ending, last_starting)
+			elif key not in lasts or starting >= lasts[key][5]:
+				lasts[key] = (resolution, measure, value, bucket_starting, bucket_ending, starting)
+	columns = ('resolution', 'measure', 'value', 'starting', 'ending', 'last_starting')
+	key = ('resolution', 'measure', 'starting')
+	execute_upsert('stat_rollups', columns, key, list(sums.values()),
+		update={'value': 'stat_rollups.value + EXCLUDED.value'}, where=None)
+	execute_upsert('stat_rollups', columns, key, list(lasts.values()),
+		update={'value': 'EXCLUDED.value', 'last_starting': 'EXCLUDED.last_starting'},
+		where='EXCLUDED.last_starting >= stat_rollups.last_starting')
+
+
+def upsert_sketches(rows):
+	"""
+	Write (measure, sketch, starting, ending) minute sketches, without committing, and re-merge the
+	hour, day and week sketches holding them, each from the sketches one level finer. Rebuilding a
+	bucket from its parts (rather than merging the new minute into it) keeps rewritten minutes from
+	counting twice whatever the sketch. Measures with a 'sketch' rollup get their rollups from these.
+	"""
+	if not rows:
+		return
+	types = sketch_types()
+	kinds = rollups()
+	columns = ('resolution', 'measure', 'sketch', 'starting', 'ending')
+	key = ('resolution', 'measure', 'starting')
+	execute_upsert('sketches', columns, key, [('minute', measure, sketch.to_bytes(), starting, ending)
+		for measure, sketch, starting, ending in rows])
+	# {(measure, starting): latest minute folded in} of the buckets written at the previous level
+	touched = dict(((measure, starting), starting) for measure, sketch, starting, ending in rows)
+	finer = 'minute'
+	for resolution in resolutions:
+		buckets = {}
+		for (measure, starting), last_starting in touched.items():
+			bucket_key = (measure, bucket(starting, resolution))
+			buckets[bucket_key] = max(last_starting, buckets.get(bucket_key, last_starting))
+		merged = []
+		estimates = []
+		for (measure, (bucket_starting, bucket_ending)), last_starting in buckets.items():
+			sketch = merge_sketches(types[measure], measure, finer, bucket_starting, bucket_ending)
+			merged.append((resolution, measure, sketch.to_bytes(), bucket_starting, bucket_ending))
+			if kinds.get(measure) == 'sketch':
+				estimates.append((resolution, measure, float(sketch.count()), bucket_starting, bucket_ending, last_starting))
+		execute_upsert('sketches', columns, key, merged)
+		execute_upsert('stat_rollups', ('resolution', 'measure', 'value', 'starting', 'ending', 'last_starting'),
+			('resolution', 'measure', 'starting'), estimates)
+		touched = dict(((measure, bucket_starting), last_starting) for (measure, (bucket_starting, bucket_ending)), last_starting in buckets.items())
+		finer = resolution
+
+
+def merge_sketches(kind, measure, resolution, starting, ending):
+	"""Merge the stored `resolution` sketches of a measure starting in [starting, ending)."""
+	query = db.session.query(Sketch.sketch).filter(Sketch.resolution == resolution, Sketch.measure == measure,
+		Sketch.starting >= starting, Sketch.starting < ending)
+	merged = kind()
+	for sketch, in query:
+		merged.merge(kind.from_bytes(sketch))
+	return merged
+
+
+def cover(starting, ending):
+	"""
+	The fewest stored buckets covering [starting, ending) to the minute, as [(resolution, starting)]:
+	whole weeks, then days, hours and minutes at its edges.
+	"""
+	cursor = bucket(naive(starting), 'minute')[0]
+	ending = bucket(naive(ending), 'minute')[0]
+	pieces = []
+	while cursor < ending:
+		for resolution in reversed(('minute',) + resolutions):
+			piece_starting, piece_ending = bucket(cursor, resolution)
+			if piece_starting == cursor and piece_ending <= ending:
+				pieces.append((resolution, cursor))
+				cursor = piece_ending
+				break
+	return pieces
+
+
+def load_sketches(kind, measure, pieces):
+	"""{(resolution, starting): sketch} of the stored sketches of a measure at pieces; buckets without events have none."""
+	sketches = {}
+	for offset in range(0, len(pieces), batch_size):
+		wanted = {}
+		for resolution, starting in pieces[offset:offset + batch_size]:
+			wanted.setdefault(resolution, []).append(starting)
+		query = db.session.query(Sketch.resolution, Sketch.starting, Sketch.sketch).filter(Sketch.measure == measure, or_(
+			*[and_(Sketch.resolution == resolution, Sketch.starting.in_(startings)) for resolution, startings in wanted.items()]))
+		for resolution, starting, sketch in query:
+			sketches[(resolution, starting)] = kind.from_bytes(sketch)
+	return sketches
+
+
+def sketch_kind(measure):
+	kind = sketch_types().get(measure)
+	if kind is None:
+		raise ValueError('{0} does not keep a sketch'.format(measure))
+	return kind
+
+
+def range_sketch(measure, starting, ending):
+	"""The merged sketch of a measure over [starting, ending), to the minute, from the fewest stored sketches."""
+	kind = sketch_kind(measure)
+	merged = kind()
+	for sketch in load_sketches(kind, measure, cover(starting, ending)).values():
+		merged.merge(sketch)
+	return merged
+
+
+def distinct_series(measure, starting, ending, resolution='day'):
+	"""[tick (ms from epoch), estimated distinct count] per hour, day, week or month of [starting, ending)."""
+	if resolution not in resolutions + ('month',):
+		raise ValueError('Unknown resolution {0!r}'.format(resolution))
+	kind = sketch_kind(measure)
+	epoch = datetime.datetime.utcfromtimestamp(0)
+	covers = []
+	current = bucket(naive(starting), resolution)[0]
+	while current < naive(ending):
+		next_starting = bucket(current, resolution)[1]
+		covers.append((current, cover(current, next_starting)))
+		current = next_starting
+	# the sketches of every point are read together, then merged per point
+	sketches = load_sketches(kind, measure, [piece for current, pieces in covers for piece in pieces])
+	points = []
+	for current, pieces in covers:
+		merged = kind()
+		for piece in pieces:
+			if piece in sketches:
+				merged.merge(sketches[piece])
+		points.append([(current - epoch).total_seconds() * 1000, merged.count()])
+	return points
+
+
+def heavy_hitters(measure, starting, ending, n=10):
+	"""[(value, count, error)] of the n most frequent values of a HeavyHitters measure over [starting, ending)."""
+	if sketch_types().get(measure) is not SpaceSaving:
+		raise ValueError('{0} does not keep the most frequent values'.format(measure))
+	return range_sketch(measure, starting, ending).top(n)
+
+
+def rebuild_rollups(starting, ending):
+	"""
+	Recompute the rollups of [starting, ending) from the minute rows, a week at a time. Every week
+	touched is replaced whole, so its minute rows must all still be stored.
+	"""
+	kinds = rollups()
+	week_starting = bucket(naive(starting), 'week')[0]
+	while week_starting < naive(ending):
+		week_ending = week_starting + datetime.timedelta(days=7)
+		rows = list(stat_rows(week_starting, week_ending, kinds))
+		try:
+			# every rollup of the week is rebuilt from zero, so replace rather than add
+			db.session.query(StatRollup).filter(
+				StatRollup.measure.in_([measure for measure, kind in kinds.items() if kind in ('sum', 'last')]),
+				StatRollup.starting >= week_starting, StatRollup.starting < week_ending).delete(synchronize_session=False)
+			update_rollups(rows, {})
+			db.session.commit()
+		except:
+			db.session.rollback()
+			raise
+		week_starting = week_ending
+
+
+def compact_stats(minutes_before=None, hours_before=None):
+	"""
+	Apply the retention policy: delete minute rows older than `minutes_before` and hourly rollups older
+	than `hours_before` (None keeps them forever), in batches of `batch_size` rows per transaction.
+
+	Minute rows are only deleted once they are folded into the rollups, so any week of minute rows
+	written before the rollups existed is rolled up first. With STAT_PARTITIONS the monthly partitions
+	that end before `minutes_before` are dropped instead. Returns the number of minute rows (or
+	partitions) and hourly rows deleted.
+	"""
+	minutes = 0
+	if minutes_before is not None:
+		ensure_rollups(minutes_before)
+		if not wide() and partitions.enabled():
+			# whole months only, so up to a month more than the retention is kept
+			minutes = len(partitions.drop_partitions(minutes_before))
+		else:
+			model = stat_model()
+			minutes = prune(model, model.starting < naive(minutes_before))
+		prune(Sketch, Sketch.resolution == 'minute', Sketch.starting < naive(minutes_before))
+	hours = 0
+	if hours_before is not None:
+		hours = prune(StatRollup, StatRollup.resolution == 'hour', StatRollup.starting < naive(hours_before))
+		prune(Sketch, Sketch.resolution == 'hour', Sketch.starting < naive(hours_before))
+	return minutes, hours
+
+
+def ensure_rollups(before):
+	"""Rebuild the rollups of every week before `before` that has minute rows but no rollups."""
+	model = stat_model()
+	oldest = db.session.query(func.min(model.starting)).filter(model.starting < naive(before)).scalar()
+	if oldest is None:
+		return
+	week_starting = bucket(oldest, 'week')[0]
+	while week_starting < naive(before):
+		week_ending = week_starting + datetime.timedelta(days=7)
+		rolled_up = db.session.query(StatRollup.id).filter(
+			StatRollup.starting >= week_starting, StatRollup.starting < week_ending).first()
+		if rolled_up is None and db.session.query(model.id).filter(
+				model.starting >= week_starting, model.starting < week_ending).first() is not None:
+			rebuild_rollups(week_starting, week_ending)
+		week_starting = week_ending
+
+
+def rolled_up_weeks(starting, ending):
+	"""The starts of the weeks overlapping [starting, ending) that already have rollups."""
+	weeks = []
+	week_starting = bucket(naive(starting), 'week')[0]
+	while week_starting < naive(ending):
+		week_ending = week_starting + datetime.timedelta(days=7)
+		if db.session.query(StatRollup.id).filter(
+				StatRollup.starting >= week_starting, StatRollup.starting < week_ending).first() is not None:
+			weeks.append(week_starting)
+		week_starting = week_ending
+	return weeks
+
+
+def prune(model, *criteria):
+	"""Delete the rows of `model` matching criteria, `batch_size` rows per transaction, so no delete holds long locks."""
+	deleted = 0
+	while True:
+		ids = [row.id for row in db.session.query(model.id).filter(*criteria).limit(batch_size)]
+		if not ids:
+			return deleted
+		try:
+			db.session.query(model).filter(model.id.in_(ids)).delete(synchronize_session=False)
+			db.session.commit()
+		except:
+			db.session.rollback()
+			raise
+		deleted += len(ids)
+
+
+def series(measures, resolution='minute', starting=None):
+	"""
+	The [tick (ms from epoch), value] points of each of measures from `starting` on (all of them when
+	None), in the order given, from the minute rows or one of the rollups. All measures are read in
+	one pass, so in the wide layout every stat_windows row is scanned and decoded once. Recent minute
+	reads are served from the in-process recent.cache, which is seeded again first when it finds
+	(checking every few seconds) that another process has written stats since.
+	"""
+	epoch = datetime.datetime.utcfromtimestamp(0)
+	points = {}
+	if resolution == 'minute':
+		if starting is not None:
+			if recent.cache.due() and recent.cache.version != stats_version():
+				seed_recent_series()
+			for measure in measures:
+				cached = recent.cache.series(measure, starting)
+				if cached is not None:
+					points[measure] = cached
+		wanted = [measure for measure in measures if measure not in points]
+		if wanted:
+			for measure in wanted:
+				points[measure] = []
+			for measure, value, stat_starting, ending in stat_rows(starting, measures=wanted):
+				points[measure].append([(stat_starting - epoch).total_seconds() * 1000, value])
+		return [points[measure] for measure in measures]
+	if resolution not in resolutions:
+		raise ValueError('Unknown resolution {0!r}'.format(resolution))
+	for measure in measures:
+		points[measure] = []
+	stats = StatRollup.query.filter(StatRollup.resolution == resolution, StatRollup.measure.in_(list(points)))
+	if starting is not None:
+		stats = stats.filter(StatRollup.starting >= bucket(naive(starting), resolution)[0])
+	for stat in stats.order_by(StatRollup.starting.asc()):
+		points[stat.measure].append([(stat.starting - epoch).total_seconds() * 1000, stat.value])
+	return [points[measure] for measure in measures]
+
+
+def seed_recent_series():
+	"""Load the minutes recent.cache holds from the database, at startup and whenever it is stale."""
+	if recent.cache.capacity <= 0:
+		return
+	# read before the rows, so a write in between leaves the cache stale rather than missing it
+	version = stats_version()
+	starting = datetime.datetime.utcnow().replace(second=0, microsecond=0) - datetime.timedelta(minutes=recent.cache.capacity - 1)
+	recent.cache.seed(stat_rows(starting), starting, version)
+
+
+def latest_user_usage(user_ids):
+	"""Return {user_id: (status, space_used)} of the given users as of each one's most recent usage delta."""
+	if not user_ids:
+		return {}
+	latest = db.session.query(UserUsage.user_id, func.max(UserUsage.recorded).label('recorded')).filter(
+		UserUsage.user_id.in_(list(user_ids))).group_by(UserUsage.user_id).subquery()
+	rows = db.session.query(UserUsage.user_id, UserUsage.status, UserUsage.space_used).join(
+		latest, (UserUsage.user_id == latest.c.user_id) & (UserUsage.recorded == latest.c.recorded))
+	return dict((user_id, (status, space_used)) for user_id, status, space_used in rows)
+
+
+def upsert_user_usage(rows, seen=()):
+	"""
+	Write (user_id, status, space_used, recorded) deltas, and the (user_id, seen) of the users listed,
+	in a single transaction; a rerun of the same hour replaces its deltas.
+	"""
+	rows = unique(rows, (0, 3))
+	seen = unique(seen, (0,))
+	try:
+		execute_upsert('user_usage', ('user_id', 'status', 'space_used', 'recorded'), ('user_id', 'recorded'), rows)
+		execute_upsert('user_seen', ('user_id', 'seen'), ('user_id',), seen)
+		db.session.commit()
+	except:
+		db.session.rollback()
+		raise
+	return len(rows)
+
+
+def unseen_users(since):
+	"""The user_ids whose latest usage delta is not 'deleted' and who have not been listed since `since`."""
+	latest = db.session.query(UserUsage.user_id, func.max(UserUsage.recorded).label('recorded')).group_by(UserUsage.user_id).subquery()
+	rows = db.session.query(UserUsage.user_id).join(
+		latest, (UserUsage.user_id == latest.c.user_id) & (UserUsage.recorded == latest.c.recorded)).filter(
+		UserUsage.status != 'deleted',
+		~db.session.query(UserSeen.id).filter(UserSeen.user_id == UserUsage.user_id, UserSeen.seen >= naive(since)).exists())
+	return [user_id for user_id, in rows]
+
+
+def user_usage_series(user_id, starting, ending, step=datetime.timedelta(hours=1)):
+	"""
+	Rebuild a user's (recorded, status, space_used) series at every `step` in [starting, ending)
+	by carrying each delta forward until the next one. Points before the first delta are left out.
+	"""
+	deltas = UserUsage.query.filter(UserUsage.user_id == user_id, UserUsage.recorded < ending).order_by(UserUsage.recorded.asc()).all()
+	series = []
+	current = None
+	index = 0
+	point = starting
+	while point < ending:
+		while index < len(deltas) and deltas[index].recorded <= point:
+			current = deltas[index]
+			index += 1
+		if current is not None:
+			series.append((point, current.status, current.space_used))
+		point += step
+	return series
+
+
+def replace_top_users(starting, users):
+	"""Store the ranked list of {'id', 'login', 'space_used'} for a usage run, replacing any earlier list for it."""
+	try:
+		TopUser.query.filter(TopUser.starting == starting).delete()
+		for rank, user in enumerate(users):
+			db.session.add(TopUser(starting, rank + 1, user['id'], user.get('login'), user['space_used']))
+		db.session.commit()
+	except:
+		db.session.rollback()
+		raise
@@ -0,0 +1,123 @@
+# tailer.py
+
+import datetime
+import threading
+from box import Box
+from measures import MeasureSet, event_types, parse_timestamp
+from store import upsert_stats
+from dedup import EventDedup
+
+
+class EventTailer(object):
+	"""
+	Follows the admin_logs stream from the saved stream position and keeps the current minute's Stat
+	rows up to date as events arrive, instead of waiting for the minute to close.
+
+	Polls every `min_interval` seconds while events are flowing and doubles the wait on every empty
+	(or failed) poll up to `max_interval`, so an idle enterprise costs almost no API calls.
+	"""
+
+	def __init__(self, tasks, min_interval=2, max_interval=60, retain=datetime.timedelta(minutes=30)):
+		self.tasks = tasks
+		self.logger = tasks.logger
+		self.min_interval = min_interval
+		self.max_interval = max_interval
+		# minutes kept open for events that Box delivers late; older late events are dropped
+		self.retain = retain
+		self.buckets = {}
+		self.dedup = EventDedup(horizon=retain)
+		self.stopped = threading.Event()
+		self.thread = None
+
+	def start(self):
+		self.thread = threading.Thread(target=self.run, name='event-tailer')
+		self.thread.daemon = True
+		self.thread.start()
+
+	def stop(self):
+		self.stopped.set()
+
+	def is_alive(self):
+		return self.thread is not None and self.thread.is_alive()
+
+	def run(self):
+		# record closed minutes (and any gap) the usual way first, which also leaves a fresh checkpoint
+		self.tasks.record_velocity()
+		interval = self.min_interval
+		while not self.stopped.is_set():
+			try:
+				received = self.poll()
+			except Exception as e:
+				self.logger.warn("Failed to tail event data from Box: {0}".format(e))
+				received = 0
+			interval = self.min_interval if received else min(interval * 2, self.max_interval)
+			self.stopped.wait(interval)
+
+	def poll(self):
+		box = Box(self.logger)
+		client = box.client()
+		if client is None:
+			return 0
+		enterprise_id = box.enterprise_id(client)
+		if enterprise_id is None:
+			return 0
+
+		now = datetime.datetime.now(datetime.timezone.utc)
+		stream_position = box.get_stream_position(enterprise_id)
+		# without a checkpoint, start at the current minute rather than the beginning of the stream
+		created_after = now.replace(second=0, microsecond=0) if str(stream_position) == '0' else None
+		measures = self.tasks.velocity_measures
+		touched = self.advance(now)
+		received = 0
+		keep_going = True
+
+		while keep_going:
+			events = client.events().get_enterprise_events(
+				limit=self.tasks.limit,
+				event_type=event_types(measures),
+				stream_position=stream_position,
+				created_after=created_after,
+			)
+			for event in events['entries']:
+				created_at = parse_timestamp(event['created_at'])
+				minute = created_at.replace(second=0, microsecond=0)
+				if minute > max(self.buckets):
+					# the page reaches past the minute open when the poll started (a minute boundary, or Box's clock ahead of ours)
+					touched |= self.advance(created_at)
+				if minute not in self.buckets:
+					self.logger.debug("Dropping event {0} from closed minute {1}".format(event['event_id'], minute))
+					continue
+				if self.dedup.seen(event['event_id'], created_at):
+					continue
+				self.buckets[minute].add(event)
+				touched.add(minute)
+				received += 1
+			self.tasks.archive_events(events['entries'])
+			stream_position = events['next_stream_position']
+			keep_going = events['chunk_size'] == self.tasks.limit
+
+		# minutes can close during a long poll once a later page advances the buckets
+		touched = sorted(minute for minute in touched if minute in self.buckets)
+		if touched:
+			upsert_stats(
+				[(measure, value, minute, minute + datetime.timedelta(minutes=1))
+					for minute in touched for measure, value in self.buckets[minute].stats()],
+				[(measure, sketch, minute, minute + datetime.timedelta(minutes=1))
+					for minute in touched for measure, sketch in self.buckets[minute].sketches()])
+		box.set_stream_position(enterprise_id, stream_position)
+		return received
+
+	def advance(self, now):
+		"""Open buckets up to the minute of `now` and drop those `retain` before it; returns the newly opened minutes."""
+		current = now.replace(second=0, microsecond=0)
+		oldest = current - self.retain
+		for minute in [minute for minute in self.buckets if minute < oldest]:
+			del self.buckets[minute]
+		opened = set()
+		minute = max(self.buckets) + datetime.timedelta(minutes=1) if self.buckets else current
+		while minute <= current:
+			self.buckets[minute] = MeasureSet(self.tasks.velocity_measures)
+			# written even if no event arrives, so idle minutes still get their zero rows
+			opened.add(minute)
+			minute += datetime.timedelta(minutes=1)
+		return opened
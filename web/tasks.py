@@ -3,101 +3,369 @@
 import os
 import fcntl
 import logging
+import math
+import time
+import queue
+import itertools
+import collections
 import datetime
-from app import db
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from app import app, db
 from box import Box
 from boxsdk import OAuth2
 from boxsdk import Client
 from apscheduler.schedulers.background import BackgroundScheduler
 from sqlalchemy.sql import exists
 from sqlalchemy.exc import SQLAlchemyError
-from models import Stat
+from models import BackfillSlice
+from measures import MeasureSet, MinuteBuckets, event_types, fields, parse_timestamp, usage_measures, velocity_measures
+from store import upsert_stats, upsert_user_usage, latest_user_usage, unseen_users, replace_top_users, compact_stats, recorded_measures
+from archive import EventArchive
+from tailer import EventTailer
+from dedup import EventDedup
+from query import EventQuery, epoch
+import partitions
+
+
+def retention(days):
+	return datetime.timedelta(days=int(days)) if int(days) > 0 else None
+
 
 class BackgroundTasks(object):
 
-	velocity_event_types=['UPLOAD','DOWNLOAD','DELETE','COLLABORATION_INVITE','COLLABORATION_ACCEPT','LOGIN']
+	velocity_measures = velocity_measures
+	usage_measures = usage_measures
 	limit = 500
+	# a window whose first page is full is split into at most this many sub-windows fetched in parallel
+	max_split = 8
+	user_limit = 1000
+	# enterprise user pages fetched concurrently once the first page gives total_count
+	user_workers = 8
+	user_attempts = 3
+	# missed minutes older than this are left to backfill.py
+	max_catch_up = datetime.timedelta(hours=24)
 
 	def __init__(self, logger):
 		self.logger = logger
 		self.scheduler = BackgroundScheduler()
+		self.recorded_until = None
+		archive_dir = app.config.get('EVENT_ARCHIVE_DIR')
+		self.archive = EventArchive(archive_dir) if archive_dir else None
+		self.tailer = EventTailer(self) if app.config.get('EVENT_TAILER') else None
+		self.user_paging = app.config.get('USER_PAGING', 'marker')
+		self.minute_retention = retention(app.config.get('STAT_MINUTE_RETENTION_DAYS', 30))
+		self.hour_retention = retention(app.config.get('STAT_HOUR_RETENTION_DAYS', 730))
 
 
-	def get_velocity_events(self, client, event_types, created_after, created_before):
-		total = 0
-		next_stream_position = 0
+	def get_velocity_events(self, client, event_types, created_after, created_before, stream_position=0, split=True):
+		# yields one page at a time as (entries, next_stream_position) so callers can fold it and let it go
+		next_stream_position = stream_position
+		first_page = True
 		keep_going = True
-		result = []
+		# one dedup per stream: pages of a stream arrive in created_at order, which its expiry relies on,
+		# while split sub-windows run their own streams and each keep their own
+		dedup = EventDedup()
 
+		while keep_going:
+			events = client.events().get_enterprise_events(
+				limit=BackgroundTasks.limit,
+				event_type=event_types,
+				stream_position=next_stream_position,
+				created_after=created_after,
+				created_before=created_before,
+			)
+			keep_going = events['chunk_size'] == BackgroundTasks.limit
+			if split and keep_going and first_page:
+				# a full first page means a burst: fetch the rest of the window as parallel sub-windows
+				windows = self.split_window(created_after, created_before, events['entries'])
+				if len(windows) > 1:
+					self.logger.info("Splitting {0} - {1} into {2} sub-windows".format(created_after, created_before, len(windows)))
+					for page in self.get_split_velocity_events(client, event_types, windows):
+						yield page
+					return
+			first_page = False
+			next_stream_position = events['next_stream_position']
+			yield [elem for elem in events['entries'] if not dedup.seen(elem['event_id'], parse_timestamp(elem['created_at']))], next_stream_position
+
+	def split_window(self, created_after, created_before, first_page):
+		# the first page holds the window's earliest events, so the time it spans estimates how many pages follow
+		window = created_before - created_after
 		try:
-			while keep_going:
-				events = client.events().get_enterprise_events(
-					limit=BackgroundTasks.limit,
-					event_type=event_types,
-					stream_position=next_stream_position,
-					created_after=created_after,
-					created_before=created_before,
-				)
-				result.extend(events['entries'])
-				count = events['chunk_size']
-				total = total + count
-				next_stream_position = events['next_stream_position']
-				keep_going = count == BackgroundTasks.limit
+			covered = parse_timestamp(first_page[-1]['created_at']) - created_after
+			count = int(math.ceil(window.total_seconds() / covered.total_seconds()))
+		except (KeyError, IndexError, ValueError, ZeroDivisionError):
+			count = BackgroundTasks.max_split
+		count = max(1, min(count, BackgroundTasks.max_split, int(window.total_seconds())))
+		step = datetime.timedelta(seconds=int(window.total_seconds()) // count)
+		bounds = [created_after + step * i for i in range(count)] + [created_before]
+		return list(zip(bounds[:-1], bounds[1:]))
 
-			return result
-		except Exception as e:
-			self.logger.warn("Failed to fetch event data from Box: {0}".format(e))
-			return []
+	def get_split_velocity_events(self, client, event_types, windows):
+		# workers hand pages over through a bounded queue so memory stays at a few pages however large the burst
+		pages = queue.Queue(maxsize=2 * len(windows))
+		cancelled = threading.Event()
+		executor = ThreadPoolExecutor(max_workers=len(windows))
+		try:
+			futures = [executor.submit(self.fetch_window, client, event_types, created_after, created_before, pages, cancelled)
+				for created_after, created_before in windows]
+			while True:
+				try:
+					yield pages.get(timeout=0.1)
+					continue
+				except queue.Empty:
+					pass
+				for future in futures:
+					if future.done() and future.exception() is not None:
+						raise future.exception()
+				if all(future.done() for future in futures) and pages.empty():
+					break
+			# the latest sub-window ends where the whole window ends in the stream
+			yield [], futures[-1].result()
+		finally:
+			cancelled.set()
+			executor.shutdown(wait=False)
+
+	def fetch_window(self, client, event_types, created_after, created_before, pages, cancelled):
+		next_stream_position = None
+		for entries, next_stream_position in self.get_velocity_events(client, event_types, created_after, created_before, split=False):
+			# sub-windows share edges; keep each event in exactly one of them
+			entries = [elem for elem in entries if created_after <= parse_timestamp(elem['created_at']) < created_before]
+			while True:
+				if cancelled.is_set():
+					return None
+				try:
+					pages.put((entries, None), timeout=0.1)
+					break
+				except queue.Full:
+					pass
+		return next_stream_position
 
 	def record_velocity(self):
 		created_before = datetime.datetime.now(datetime.timezone.utc).replace(second=0, microsecond=0)
 		created_after = created_before + datetime.timedelta(minutes=-1)
-		client = Box(self.logger).client()
+		box = Box(self.logger)
+		client = box.client()
 		if client is None:
 			self.logger.warn("Client was not created. Events will not be fetched.")
 			return
 
-		events = self.get_velocity_events(client, BackgroundTasks.velocity_event_types, created_after, created_before)
+		# after a restart or a failed run, sweep every missed minute together with the current one
+		missing = [] if self.recorded_until == created_after else self.find_velocity_gap(created_after)
+		sweep_after = missing[0] if missing else created_after
+		if missing:
+			self.logger.info("Catching up {0} missed minutes since {1}".format(len(missing), sweep_after))
+
+		# resume the admin_logs stream where the previous run left off so Box only returns new events. The
+		# checkpoint sits past the events of the window this process recorded last, so it is only used for the
+		# window right after it; anything else (a catch-up sweep, a rerun of a recorded minute, the first run
+		# after a restart) reaches back before the checkpoint and starts from the created_after bound instead
+		enterprise_id = box.enterprise_id(client)
+		resume = enterprise_id is not None and not missing and self.recorded_until == created_after
+		stream_position = box.get_stream_position(enterprise_id) if resume else 0
+		next_stream_position = None
+		# every minute row is recomputed from scratch and overwritten, so duplicates only matter within one sweep
+		buckets = MinuteBuckets(BackgroundTasks.velocity_measures, sweep_after, created_before)
+
+		try:
+			pages = self.get_velocity_events(client, event_types(buckets.measures), sweep_after, created_before, stream_position)
+			for entries, next_stream_position in pages:
+				buckets.add_all(entries)
+				self.archive_events(entries)
+		except Exception as e:
+			# partial counts would be wrong, so leave the window empty rather than record them
+			self.logger.warn("Failed to fetch event data from Box: {0}".format(e))
+			return
+
+		wanted = set(missing) | set([created_after])
+		rows = [row for row in buckets.rows() if row[2] in wanted]
+		try:
+			upsert_stats(rows, [row for row in buckets.sketch_rows() if row[2] in wanted])
+		except Exception as e:
+			self.logger.warn('Caught exception when adding event stats: {}'.format(e))
+			return
+		self.recorded_until = created_before
+		self.logger.debug("Event stats: {0}".format([row[:2] for row in rows if row[2] == created_after]))
+
+		if enterprise_id is not None and next_stream_position is not None:
+			box.set_stream_position(enterprise_id, next_stream_position)
 
-		for event_type in BackgroundTasks.velocity_event_types:
-			count = len([elem for elem in events if elem['event_type'] == event_type])
-			stat = Stat(event_type, count, created_after, created_before)
-			db.session.add(stat)
+	def find_velocity_gap(self, created_after):
+		# minutes between the oldest recent row and created_after that are missing a row for some measure
+		names = [name for measure in BackgroundTasks.velocity_measures for name in measure.stat_names()]
+		since = created_after - BackgroundTasks.max_catch_up
+		counts = recorded_measures(names, since, created_after)
+		counts = dict((starting.replace(tzinfo=datetime.timezone.utc), count) for starting, count in counts.items())
+		if not counts:
+			# nothing recent to anchor on; history before that is backfill's job
+			return []
+		missing = []
+		minute = min(counts)
+		while minute < created_after:
+			if counts.get(minute, 0) < len(names):
+				missing.append(minute)
+			minute += datetime.timedelta(minutes=1)
+		return missing
+
+	def fetch_velocity_slice(self, client, starting, ending):
+		buckets = MinuteBuckets(BackgroundTasks.velocity_measures, starting, ending)
+		for entries, next_stream_position in self.get_velocity_events(client, event_types(buckets.measures), starting, ending, split=False):
+			buckets.add_all(entries)
+			self.archive_events(entries)
+		return list(buckets.rows()), list(buckets.sketch_rows())
+
+	def archive_events(self, entries):
+		if self.archive is None or not entries:
+			return
+		try:
+			self.archive.append(entries)
+		except Exception as e:
+			self.logger.warn("Failed to archive events: {0}".format(e))
+
+	def recompute_velocity(self, starting, ending):
+		# rebuild Stat rows from the local archive, one day at a time, without calling Box
+		if self.archive is None:
+			self.logger.warn("EVENT_ARCHIVE_DIR is not set. Nothing to recompute from.")
+			return False
+		query = EventQuery(self.archive)
+		minute = datetime.timedelta(minutes=1)
+		day = starting
+		while day < ending:
+			next_day = min(day + datetime.timedelta(days=1), ending)
+			frame = query.load(day, next_day)
+			rows = []
+			sketches = []
+			unsupported = []
+			for measure in BackgroundTasks.velocity_measures:
+				if measure.sketch is not None:
+					# sketches need the values themselves, which the columnar counts do not keep
+					unsupported.append(measure)
+					continue
+				try:
+					values = frame.measure(measure, bucket='minute')
+				except (KeyError, ValueError):
+					# measures on fields the archive does not keep as columns go through the event-by-event path
+					unsupported.append(measure)
+					continue
+				starting_minute = day
+				while starting_minute < next_day:
+					rows.append((measure.name, values.get(epoch(starting_minute), 0), starting_minute, starting_minute + minute))
+					starting_minute += minute
+			if unsupported:
+				buckets = MinuteBuckets(unsupported, day, next_day)
+				buckets.add_all(self.archive.read(day, next_day))
+				rows.extend(buckets.rows())
+				sketches.extend(buckets.sketch_rows())
 			try:
-				db.session.commit()
+				upsert_stats(rows, sketches)
 			except Exception as e:
-				self.logger.debug('Caught exception: {}'.format(e))
-				db.session.rollback()
+				self.logger.warn("Failed to recompute {0} - {1}: {2}".format(day, next_day, e))
+				return False
+			self.logger.info("Recomputed {0} - {1} from the archive".format(day, next_day))
+			day = next_day
+		return True
 
-		unique_user_count = len(set([elem['created_by']['login'] for elem in events]))
-		stat = Stat('UNIQUE_USERS', unique_user_count, created_after, created_before)
-		db.session.add(stat)
-		try:
-			db.session.commit()
-		except:
-			self.logger.debug('Caught exception when adding event stats: {}'.format(e))
-			db.session.rollback()
-		else:
-			self.logger.info("inserted %s unqiue users" % unique_user_count)
+	def backfill_velocity(self, starting, ending, slice_minutes=360, workers=4):
+		# a slice reaching past now would be recorded as done with the rest of its minutes still empty
+		ending = min(ending, datetime.datetime.now(datetime.timezone.utc).replace(second=0, microsecond=0))
+		if starting >= ending:
+			self.logger.warn("Nothing to backfill: {0} is not before {1}".format(starting, ending))
+			return False
+
+		client = Box(self.logger).client()
+		if client is None:
+			self.logger.warn("Client was not created. Events will not be backfilled.")
+			return False
+
+		done = set((elem.starting, elem.ending) for elem in BackfillSlice.query.filter(
+			BackfillSlice.starting >= starting.replace(tzinfo=None),
+			BackfillSlice.ending <= ending.replace(tzinfo=None)))
+		slices = []
+		slice_starting = starting
+		while slice_starting < ending:
+			slice_ending = min(slice_starting + datetime.timedelta(minutes=slice_minutes), ending)
+			if (slice_starting.replace(tzinfo=None), slice_ending.replace(tzinfo=None)) not in done:
+				slices.append((slice_starting, slice_ending))
+			slice_starting = slice_ending
+		self.logger.info("Backfilling {0} slices ({1} already done) with {2} workers".format(len(slices), len(done), workers))
+
+		# slices are fetched concurrently; rows are written from this thread only since the db session is not shared
+		failed = 0
+		with ThreadPoolExecutor(max_workers=workers) as executor:
+			futures = dict((executor.submit(self.fetch_velocity_slice, client, slice_starting, slice_ending), (slice_starting, slice_ending))
+				for slice_starting, slice_ending in slices)
+			for future in as_completed(futures):
+				slice_starting, slice_ending = futures[future]
+				try:
+					rows, sketches = future.result()
+					upsert_stats(rows, sketches)
+					db.session.add(BackfillSlice(slice_starting, slice_ending))
+					db.session.commit()
+				except Exception as e:
+					db.session.rollback()
+					failed += 1
+					self.logger.warn("Failed to backfill {0} - {1}: {2}".format(slice_starting, slice_ending, e))
+				else:
+					self.logger.info("Backfilled {0} - {1}".format(slice_starting, slice_ending))
+		return failed == 0
 
 	def get_users(self, client):
-		keep_going = True
-		result = []
+		# yields one page of users at a time so callers can fold it and let it go
+		if self.user_paging == 'marker':
+			return self.get_users_by_marker(client)
+		return self.get_users_by_offset(client)
 
-		try:
-			while keep_going:
-				users = client.user().get_enterprise_users(
-					offset=len(result),
-					limit=1000
-				)
-				result.extend(users['entries'])
-				self.logger.info("got {0}/{1} enterprise users...".format(len(result), users['total_count']))
-				keep_going = len(result) < users['total_count']
+	def get_users_by_marker(self, client):
+		# each marker comes with the previous page, so pages are sequential; the next one is fetched
+		# while the caller folds the current one
+		received = 0
+		with ThreadPoolExecutor(max_workers=1) as executor:
+			pending = executor.submit(self.get_user_page, client, marker=None)
+			while pending is not None:
+				users = pending.result()
+				marker = users.get('next_marker')
+				pending = executor.submit(self.get_user_page, client, marker=marker) if marker else None
+				received += len(users['entries'])
+				self.logger.info("got {0} enterprise users...".format(received))
+				yield users['entries']
 
-			return result
-		except Exception as e:
-			self.logger.warn("Failed to fetch user data from Box: {0}".format(e))
-			return []
+	def get_users_by_offset(self, client):
+		users = self.get_user_page(client, offset=0)
+		total_count = users['total_count']
+		received = len(users['entries'])
+		yield users['entries']
+
+		# the first page tells how many offsets remain; fetch them concurrently over the client's one session,
+		# with only a few pages in flight so memory stays at a handful of pages
+		offsets = iter(range(BackgroundTasks.user_limit, total_count, BackgroundTasks.user_limit))
+		with ThreadPoolExecutor(max_workers=BackgroundTasks.user_workers) as executor:
+			pending = collections.deque(executor.submit(self.get_user_page, client, offset=offset)
+				for offset in itertools.islice(offsets, BackgroundTasks.user_workers))
+			while pending:
+				users = pending.popleft().result()
+				for offset in itertools.islice(offsets, 1):
+					pending.append(executor.submit(self.get_user_page, client, offset=offset))
+				received += len(users['entries'])
+				self.logger.info("got {0}/{1} enterprise users...".format(received, total_count))
+				yield users['entries']
+
+	def get_user_page(self, client, offset=0, marker=None):
+		# a failed page is retried on its own so one bad request does not cost the whole directory scan
+		for attempt in range(BackgroundTasks.user_attempts):
+			try:
+				return client.user().get_enterprise_users(
+					offset=offset,
+					limit=BackgroundTasks.user_limit,
+					use_marker=self.user_paging == 'marker',
+					marker=marker,
+					# only what the usage measures read, which keeps pages small to send and parse
+					fields=fields(BackgroundTasks.usage_measures),
+				)
+			except Exception as e:
+				if attempt + 1 == BackgroundTasks.user_attempts:
+					raise
+				self.logger.info("Retrying enterprise users at {0}: {1}".format(marker or offset, e))
+				time.sleep(2 ** attempt)
 
 	def record_usage(self):
 		client = Box(self.logger).client()
@@ -107,32 +375,89 @@ class BackgroundTasks(object):
 			
 		starting = datetime.datetime.now(datetime.timezone.utc).replace(minute=0, second=0, microsecond=0)
 		ending = starting + datetime.timedelta(days=1)
-		users = self.get_users(client)
-		active = len([elem for elem in users if elem['status'] == 'active'])
-		inactive = len([elem for elem in users if elem['status'] == 'inactive'])
-		storage_used = sum(map(lambda user: user['space_used'], users))
-		self.logger.debug("User stats: {0} active; {1} inactive; {2} GB used".format(active, inactive, storage_used/(1024*1024*1024)))
-		db.session.add(Stat('ACTIVE_USERS', active, starting, ending))
-		db.session.add(Stat('INACTIVE_USERS', inactive, starting, ending))
-		db.session.add(Stat('STORAGE_USED_GB', storage_used/(1024*1024*1024), starting, ending))
+		measures = MeasureSet(BackgroundTasks.usage_measures)
+		# per-user history only stores the users whose status or space_used changed since their latest delta;
+		# each page is compared with its users' stored deltas, so only one page of users is held at a time
+		changes = 0
 		try:
-			db.session.commit()
+			for users in self.get_users(client):
+				measures.add_all(users)
+				latest = latest_user_usage([user['id'] for user in users])
+				changed = []
+				for user in users:
+					state = (user.get('status'), user.get('space_used') or 0)
+					if latest.get(user['id']) != state:
+						changed.append((user['id'], state[0], state[1], starting))
+				changes += upsert_user_usage(changed, [(user['id'], starting) for user in users])
 		except Exception as e:
-			self.logger.debug('Caught exception when adding user stats: {}'.format(e))
-			db.session.rollback()
-			
+			# totals over part of the directory would be wrong, so record no stats for this hour; the deltas
+			# already written are true of their users, and deleted users are only looked for after a full run
+			self.logger.warn("Failed to fetch user data from Box: {0}".format(e))
+			return
+		self.logger.debug("User stats: {0}".format(measures.stats()))
+		try:
+			upsert_stats((measure, value, starting, ending) for measure, value in measures.stats())
+			replace_top_users(starting, measures.result('TOP_STORAGE_USERS'))
+		except Exception as e:
+			self.logger.warn('Caught exception when adding user stats: {}'.format(e))
+
+		# users recorded before but not listed in this run have been deleted
+		try:
+			changes += upsert_user_usage((user_id, 'deleted', 0, starting) for user_id in unseen_users(starting))
+		except Exception as e:
+			self.logger.warn('Caught exception when adding user usage: {}'.format(e))
+		else:
+			self.logger.debug("Recorded usage changes for {0} users".format(changes))
+
+	def retention_cutoffs(self):
+		"""(minutes_before, hours_before): minute rows and hourly rollups older than these are dropped; None keeps them."""
+		today = datetime.datetime.now(datetime.timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+		return tuple(None if kept is None else today - kept for kept in (self.minute_retention, self.hour_retention))
+
+	def compact_stats(self):
+		minutes_before, hours_before = self.retention_cutoffs()
+		try:
+			minutes, hours = compact_stats(minutes_before, hours_before)
+		except Exception as e:
+			self.logger.warn("Failed to compact stats: {0}".format(e))
+			return
+		self.logger.info("Compacted stats: deleted {0} minute rows before {1} and {2} hourly rows before {3}".format(
+			minutes, minutes_before, hours, hours_before))
+
+	def create_stat_partitions(self):
+		if not partitions.enabled():
+			return
+		now = datetime.datetime.now(datetime.timezone.utc)
+		try:
+			# this month and the next two, so writes never wait on DDL at a month boundary
+			partitions.ensure_partitions(now, now + datetime.timedelta(days=62))
+		except Exception as e:
+			self.logger.warn("Failed to create stat partitions: {0}".format(e))
+
 	def schedule(self):
 		self.logger.info("Starting scheduler")
 		self.scheduler.start()
-		self.scheduler.add_job(self.record_velocity, 'interval', minutes=1, coalesce=True)
-		self.logger.debug("Scheduled event job to run every minute")
+		if self.tailer is not None:
+			self.tailer.start()
+			self.logger.debug("Started event tailer")
+		else:
+			self.scheduler.add_job(self.record_velocity, 'interval', minutes=1, coalesce=True)
+			self.logger.debug("Scheduled event job to run every minute")
 		self.scheduler.add_job(self.record_usage, 'interval', minutes=60, coalesce=True)
 		self.logger.debug("Scheduled usage job to run every hour")
+		self.scheduler.add_job(self.compact_stats, 'cron', hour=3, coalesce=True)
+		self.logger.debug("Scheduled compaction job to run every day")
+		self.scheduler.add_job(self.create_stat_partitions, 'cron', hour=2, coalesce=True)
+		self.logger.debug("Scheduled partition job to run every day")
 		
 	def trigger_usage_job(self):
 		self.scheduler.add_job(self.record_usage, 'date', run_date=datetime.datetime.now() + datetime.timedelta(seconds=1), coalesce=True)
 		self.logger.debug("Scheduled on-demand usage job")
 		
 	def trigger_event_job(self):
+		if self.tailer is not None and self.tailer.is_alive():
+			# the tailer owns the stream position; it is already up to date
+			self.logger.debug("Event tailer is running; on-demand event job skipped")
+			return
 		self.scheduler.add_job(self.record_velocity, 'date', run_date=datetime.datetime.now() + datetime.timedelta(seconds=1), coalesce=True)
 		self.logger.debug("Scheduled on-demand event job")
\ No newline at end of file